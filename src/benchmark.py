@@ -0,0 +1,420 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic benchmarks of the plot and utils modules
+"""
+
+# Load external dependencies
+from setup import *
+import os, sys, copy, json, time, platform, subprocess
+# Load internal dependencies
+import config, utils, plot, panels
+
+# Default scales
+LOCI = [10**3, 10**4, 10**5, 10**6, 10**7]
+CLONES = [10, 100, 1000, 10000]
+
+# Cases whose input matrix exceeds this number of cells are skipped
+# (about 800 MB of float64)
+MAX_CELLS = 10**8
+
+# Default output, one JSON record per case and line
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'benchmark.jsonl')
+
+### Synthetic inputs ###
+def _random_state(random_state):
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+def synthetic_loci(n_loci, random_state=None):
+    """
+    Sorted, distinct loci drawn uniformly along the reference genome
+
+    Output
+    -----
+      pandas dataframe with columns chr_arabic, chr_roman, pos and pos_cum
+    """
+    rs = _random_state(random_state)
+    genome = utils.genome_coordinates()
+    total = int(genome.ends[-1])
+    pos_cum = np.unique(rs.randint(1, total, size=int(n_loci * 1.1) + 10))
+    pos_cum = np.sort(rs.choice(pos_cum, size=min(n_loci, len(pos_cum)), replace=False))
+    chrom, pos = genome.from_cum(pos_cum)
+    df = pd.DataFrame({'chr_arabic': chrom, 'pos': pos, 'pos_cum': pos_cum},
+                      columns=['chr_arabic', 'chr_roman', 'pos', 'pos_cum'])
+    roman = dict((c, utils.int_to_roman(c)) for c in genome.chroms)
+    df['chr_roman'] = df['chr_arabic'].map(roman)
+    return df
+
+def _segments(rs, n_rows, n_cols, values, n_breaks, fill=np.nan):
+    """
+    Rows of piecewise constant values, with `n_breaks` breakpoints per row
+    on average, as produced by a segmentation
+    """
+    out = np.full((n_rows, n_cols), fill)
+    for ii in range(n_rows):
+        k = rs.poisson(n_breaks)
+        breaks = np.unique(np.r_[0, rs.randint(0, n_cols, size=k), n_cols])
+        seg = rs.choice(values, size=len(breaks) - 1)
+        out[ii] = np.repeat(seg, np.diff(breaks))
+    return out
+
+def synthetic_frequency(n_loci, n_times=6, random_state=None):
+    """
+    Allele frequencies of up to six time points along the genome, laid
+    out as `gw_frequency` takes them (as in figure 2): one row per locus,
+    a `pos_cum` column and one column per time point
+    """
+    times = sorted(config.time['color'])[:n_times]
+    rs = _random_state(random_state)
+    loci = synthetic_loci(n_loci, rs)
+    steps = rs.normal(0, 0.02, size=(len(loci), len(times)))
+    freq = np.clip(0.5 + np.cumsum(steps, axis=0) * np.linspace(0, 1, len(times)), 0, 1)
+    freq[rs.rand(*freq.shape) < 0.01] = np.nan
+    df = pd.DataFrame(freq, columns=times)
+    df.insert(0, 'pos_cum', loci['pos_cum'].values)
+    return df
+
+def synthetic_genotypes(n_loci, n_clones, n_sets=4, snv_rate=1e-3, random_state=None):
+    """
+    Consensus and de novo genotypes of clones, laid out as
+    `genome_instability` takes them (as in figure 4)
+
+    Clones are split into `n_sets` sets, each with a consensus row and,
+    per clone, one row each of SNV/indel, copy number and LOH genotypes.
+
+    Output
+    -----
+      pandas dataframe indexed by (selection, population, time, set, clone,
+      lineage, type, ploidy), with columns (chr_arabic, chr_roman, pos_cum,
+      gene)
+    """
+    rs = _random_state(random_state)
+    loci = synthetic_loci(n_loci, rs)
+    n = len(loci)
+    n_sets = max(1, min(n_sets, n_clones))
+    lineages = [l for l in sorted(config.lineages) if l.startswith('subclone')]
+
+    # Genes at de novo SNV/indel loci
+    snv = np.flatnonzero(rs.rand(n) < snv_rate)
+    if len(snv) == 0:
+        snv = rs.choice(n, size=1)
+    gene = np.array(['non-coding'] * n, dtype=object)
+    gene[snv] = ['GENE%d' % ii for ii in range(len(snv))]
+    columns = pd.MultiIndex.from_arrays(
+        [loci['chr_arabic'].values, loci['chr_roman'].values, loci['pos_cum'].values, gene],
+        names=['chr_arabic', 'chr_roman', 'pos_cum', 'gene']
+    )
+
+    index, blocks = [], []
+    for s, clones in enumerate(np.array_split(np.arange(n_clones), n_sets)):
+        lineage = lineages[s % len(lineages)]
+        key = ('HU', 'WAxNA_F12_1_HU_1', 32, s)
+        # Consensus
+        index.append(key + ('', lineage, 'consensus', 'diploid'))
+        blocks.append(_segments(rs, 1, n, [0, 1, 2], 20))
+        # De novo
+        snv_values = np.full((len(clones), n), np.nan)
+        snv_values[:, snv] = rs.choice([0, 1, 2], size=(len(clones), len(snv)))
+        cn = _segments(rs, len(clones), n, [np.nan] * 8 + [1, 3], 2)
+        loh = _segments(rs, len(clones), n, [0] * 8 + [-1, 1], 2, fill=0)
+        for t, values in [('snv_indel', snv_values), ('copy_number', cn), ('loh', loh)]:
+            index.extend(key + ('%d' % c, lineage, t, 'diploid') for c in clones)
+            blocks.append(values)
+
+    index = pd.MultiIndex.from_tuples(
+        index, names=['selection', 'population', 'time', 'set', 'clone', 'lineage', 'type', 'ploidy']
+    )
+    return pd.DataFrame(np.vstack(blocks), index=index, columns=columns)
+
+def synthetic_hybrids(n_clones, random_state=None):
+    """
+    Square matrix of hybrid growth rates relative to the parents, laid out
+    as `heatmap_hybrids` takes it (as in figure 6)
+    """
+    rs = _random_state(random_state)
+    labels = ['C%d' % ii for ii in range(n_clones)]
+    effect = rs.normal(0, 0.1, size=n_clones)
+    H = effect[:, None] + effect[None, :] + rs.normal(0, 0.05, size=(n_clones, n_clones))
+    H[rs.rand(n_clones, n_clones) < 0.05] = np.nan
+    return pd.DataFrame(H,
+                        index=pd.Index(labels, name=u'MATa'),
+                        columns=pd.Index(labels, name=u'MATα'))
+
+def synthetic_phenotypes(n_clones, n_replicates=4, random_state=None):
+    """
+    Phenotype table of random crosses between `n_clones` MATa and MATα
+    clones, with MATa/MATα column pairs as combined by `combine_columns`
+    (as in figure 6)
+    """
+    rs = _random_state(random_state)
+    n = n_clones * n_replicates
+    strains = np.array(['C%d' % ii for ii in range(n_clones)], dtype=object)
+    genotypes = np.array(['+', '-', 'RNR2-Q', 'FPR1-L'], dtype=object)
+    return pd.DataFrame({
+        u'strain_MATa': strains[rs.randint(0, n_clones, size=n)],
+        u'strain_MATα': strains[rs.randint(0, n_clones, size=n)],
+        u'genotype_short_MATa': genotypes[rs.randint(0, len(genotypes), size=n)],
+        u'genotype_short_MATα': genotypes[rs.randint(0, len(genotypes), size=n)],
+        u'norm_growth_rate': rs.normal(0, 0.1, size=n)
+    })
+
+### Cases ###
+# Each case prepares its input, then returns a callable running the
+# function and, for plots, the figure to draw.
+
+def _gw_frequency(n_loci, n_clones, random_state):
+    data = synthetic_frequency(n_loci, random_state=random_state)
+    times = list(data.columns[1:])
+    def call():
+        fig = plt.figure(figsize=(6, 1.5))
+        ax = fig.add_subplot(111)
+        plot.gw_frequency(data, ax, x='pos_cum', y=times,
+                          color=[config.time['color'][t] for t in times],
+                          alpha=0.6, linewidth=0.4)
+        return fig
+    return call, n_loci * len(times)
+
+def _genome_instability(n_loci, n_clones, random_state):
+    data = synthetic_genotypes(n_loci, n_clones, random_state=random_state)
+    n_sets = data.index.get_level_values('set').nunique()
+    def call():
+        fig = plt.figure(figsize=(4, 4))
+        grid = gridspec.GridSpec(n_clones + n_sets, 1, hspace=0, wspace=0)
+        plot.genome_instability(data, ax=grid, title='')
+        return fig
+    return call, data.size
+
+def _heatmap_hybrids(n_loci, n_clones, random_state):
+    H = synthetic_hybrids(n_clones, random_state=random_state)
+    labels = list(H.index)
+    def call():
+        fig = plt.figure(figsize=(4, 4))
+        ax = fig.add_subplot(111)
+        plot.heatmap_hybrids(H, ax, '', '', '', labels, labels,
+                             cmap=copy.copy(plt.cm.RdBu_r), vmin=-0.3, vmax=0.3)
+        return fig
+    return call, H.size
+
+def _combine_columns(n_loci, n_clones, random_state):
+    df = synthetic_phenotypes(n_clones, random_state=random_state)
+    def call():
+        utils.combine_columns(df, u'strain_MATa', u'strain_MATα')
+        utils.combine_columns(df, u'genotype_short_MATa', u'genotype_short_MATα', mirror=False)
+    return call, len(df)
+
+# Function name -> (case, whether it depends on the number of loci, and
+# on the number of clones)
+CASES = {
+    'gw_frequency': (_gw_frequency, True, False),
+    'genome_instability': (_genome_instability, True, True),
+    'heatmap_hybrids': (_heatmap_hybrids, False, True),
+    'combine_columns': (_combine_columns, False, True)
+}
+
+def _input_cells(name, n_loci, n_clones):
+    """
+    Size of the input of a case, known before building it
+    """
+    if name == 'gw_frequency':
+        return n_loci * 6
+    if name == 'genome_instability':
+        return n_loci * (3 * n_clones + min(n_clones, 4))
+    if name == 'heatmap_hybrids':
+        return n_clones**2
+    return n_clones * 4
+
+def _clone_counts(name, n_loci, clones, max_cells):
+    """
+    Numbers of clones to run at a number of loci
+
+    If some numbers of clones do not fit in `max_cells`, the smallest of
+    them is halved until it fits and added, so that every number of loci
+    is measured with as many clones as possible.
+    """
+    fit = [c for c in clones if _input_cells(name, n_loci, c) <= max_cells]
+    skipped = [c for c in clones if c not in fit]
+    if not skipped:
+        return list(clones)
+    n = min(skipped) // 2
+    while n > 0 and _input_cells(name, n_loci, n) > max_cells:
+        n //= 2
+    if n > max(fit + [0]):
+        fit.append(n)
+    return sorted(fit + skipped)
+
+def environment():
+    """
+    Versions of the interpreter, of the libraries and of the repository
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull
+            ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'matplotlib': mpl.__version__,
+        'backend': mpl.get_backend(),
+        'machine': platform.machine(),
+        'node': platform.node()
+    }
+
+def run_case(name, n_loci, n_clones, repeat=3, dpi=150, random_state=0):
+    """
+    Time one function at one scale
+
+    Each repetition builds the synthetic input ('prep'), runs the function
+    ('call') and, for plots, renders the figure off screen ('draw').
+
+    Output
+    -----
+      dict with the case, the size of the input and the list of timings
+      of each phase, in seconds
+    """
+    case = CASES[name][0]
+    timings = {'prep': [], 'call': [], 'draw': []}
+    for ii in range(repeat):
+        t0 = time.time()
+        call, cells = case(n_loci, n_clones, random_state)
+        t1 = time.time()
+        fig = call()
+        t2 = time.time()
+        timings['prep'].append(t1 - t0)
+        timings['call'].append(t2 - t1)
+        if fig is not None:
+            fig.savefig(os.devnull, format='png', dpi=dpi)
+            timings['draw'].append(time.time() - t2)
+            plt.close(fig)
+    if not timings['draw']:
+        del timings['draw']
+    return {'function': name, 'loci': n_loci, 'clones': n_clones,
+            'cells': int(cells), 'repeat': repeat, 'dpi': dpi,
+            'status': 'ok', 'seconds': timings}
+
+def run(functions=None, loci=LOCI, clones=CLONES, repeat=3, dpi=150, max_cells=MAX_CELLS,
+        out=RESULTS, cache=False, random_state=0):
+    """
+    Time the plot and utils functions over a grid of scales
+
+    Records are appended to `out` as JSON lines, each with the environment
+    (see `environment`) and the date of the run, so that successive runs
+    can be compared with `load_results`. Functions that do not depend on
+    the number of loci (or of clones) are run once per number of clones
+    (or of loci). Cases larger than `max_cells` are recorded as skipped;
+    where that leaves out the largest numbers of clones at a number of
+    loci, the largest number of clones that fits is run instead (see
+    `_clone_counts`). Cases that raise an exception are recorded with status 'error'
+    and the exception text, without stopping the sweep.
+
+    Input
+    -----
+      functions : names of the functions to time (default: all of `CASES`)
+      loci, clones : scales
+      repeat : number of repetitions of each case
+      dpi : resolution of the rendered figures
+      max_cells : largest input size
+      out : output filename (None to only return the records)
+      cache : use the panel render cache (see `panels`)
+
+    Output
+    -----
+      list of records
+    """
+    functions = sorted(CASES) if functions is None else functions
+    env = environment()
+    date = time.strftime('%Y-%m-%dT%H:%M:%S')
+    enabled = panels.ENABLED
+    panels.ENABLED = cache
+    records = []
+    try:
+        for name in functions:
+            _, by_loci, by_clones = CASES[name]
+            for n_loci in (loci if by_loci else [None]):
+                if by_loci and by_clones:
+                    counts = _clone_counts(name, n_loci, clones, max_cells)
+                else:
+                    counts = clones if by_clones else [None]
+                for n_clones in counts:
+                    cells = _input_cells(name, n_loci, n_clones)
+                    if cells > max_cells:
+                        record = {'function': name, 'loci': n_loci, 'clones': n_clones,
+                                  'cells': int(cells), 'status': 'skipped'}
+                    else:
+                        try:
+                            record = run_case(name, n_loci, n_clones, repeat=repeat,
+                                              dpi=dpi, random_state=random_state)
+                        except Exception as e:
+                            plt.close('all')
+                            record = {'function': name, 'loci': n_loci, 'clones': n_clones,
+                                      'cells': int(cells), 'status': 'error',
+                                      'error': '%s: %s' % (type(e).__name__, e)}
+                    record.update({'date': date, 'cache': cache, 'environment': env})
+                    records.append(record)
+                    if out is not None:
+                        _append(out, record)
+    finally:
+        panels.ENABLED = enabled
+    return records
+
+def _append(fn, record):
+    dirname = os.path.dirname(fn)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(fn, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+def load_results(fn=RESULTS):
+    """
+    Benchmark records as a dataframe, with the best time of each phase
+
+    Output
+    -----
+      pandas dataframe with one row per case and run, and columns commit,
+      date, function, loci, clones, cells, status, error and prep/call/draw
+    """
+    rows = []
+    with open(fn, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            row = dict((k, r.get(k)) for k in ['date', 'function', 'loci', 'clones', 'cells', 'status', 'error'])
+            row['commit'] = r.get('environment', {}).get('commit')
+            for phase in ['prep', 'call', 'draw']:
+                values = r.get('seconds', {}).get(phase)
+                row[phase] = min(values) if values else np.nan
+            rows.append(row)
+    return pd.DataFrame(rows, columns=['commit', 'date', 'function', 'loci', 'clones', 'cells',
+                                       'status', 'error', 'prep', 'call', 'draw'])
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('functions', nargs='*', help='functions to time (default: all)')
+    parser.add_argument('--loci', type=int, nargs='+', default=LOCI)
+    parser.add_argument('--clones', type=int, nargs='+', default=CLONES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--max-cells', type=int, default=MAX_CELLS)
+    parser.add_argument('--cache', action='store_true', help='use the panel render cache')
+    parser.add_argument('--out', default=RESULTS)
+    args = parser.parse_args()
+    for name in args.functions:
+        if name not in CASES:
+            parser.error('unknown function %s (choose from %s)' % (name, ', '.join(sorted(CASES))))
+
+    for r in run(args.functions or None, loci=args.loci, clones=args.clones, repeat=args.repeat,
+                 dpi=args.dpi, max_cells=args.max_cells, out=args.out, cache=args.cache):
+        seconds = ' '.join('%s=%.3f' % (k, min(v)) for k, v in sorted(r.get('seconds', {}).items()))
+        sys.stdout.write('%-20s loci=%-9s clones=%-6s %s\n' %
+                         (r['function'], r['loci'], r['clones'], seconds or r.get('error', r['status'])))
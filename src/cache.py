@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Columnar dataset cache
+"""
+
+# Load external dependencies
+from setup import *
+import os, json, shutil, hashlib
+# Load internal dependencies
+import utils
+
+# Columns stored as pandas categoricals
+CATEGORIES = ('selection', 'population', 'sample', 'gene', 'genotype')
+
+# Columns used to partition the table into row groups
+GROUP_BY = ('selection', 'population')
+
+# Default arguments to pandas.read_csv, as used in the notebooks
+READ_CSV = {'encoding': 'utf-8', 'keep_default_na': False}
+
+VERSION = 1
+
+def _meta_path(path):
+    return os.path.join(path, 'meta.json')
+
+def read_meta(path):
+    with open(_meta_path(path), 'r') as f:
+        return json.load(f)
+
+def source_stamp(fn, kwargs):
+    """
+    Identify the source file and the arguments it was parsed with
+    """
+    st = os.stat(fn)
+    key = json.dumps(sorted((k, repr(v)) for k, v in kwargs.items()))
+    return {
+        'path': os.path.abspath(fn),
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'kwargs': hashlib.md5(key.encode('utf-8')).hexdigest()
+    }
+
+def _as_python(value):
+    """
+    Convert numpy scalars to JSON-serialisable python values
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _to_str(values):
+    """
+    Strings of the non-missing values of an object column
+    """
+    return values.map(lambda v: v if isinstance(v, (str, type(u''))) or pd.isnull(v) else u'%s' % (v,))
+
+def write_table(df, path, group_by=GROUP_BY, source=None, to_str=()):
+    """
+    Store a dataframe as one binary array per column
+
+    Object columns are dictionary-encoded (integer codes plus sorted
+    categories). Rows are stably sorted by the `group_by` keys so that
+    each key combination is a contiguous row group. The index is not
+    stored. Frames with non-string column names or with object columns
+    holding anything other than strings (e.g. dates or tuples) raise a
+    ValueError, as they would not be read back unchanged, unless the
+    column is listed in `to_str`.
+
+    Input
+    -----
+      df : pandas dataframe
+      path : cache directory
+      group_by : columns used to partition the rows
+      source : optional stamp of the source file (see `read_csv`)
+      to_str : object columns whose non-string values (e.g. numbers
+          parsed from some chunks of a CSV file) are stored as strings;
+          converted columns are flagged in the metadata
+    """
+    df = df.reset_index(drop=True)
+    group_by = [c for c in group_by if c in df.columns]
+    converted = set()
+    for name in to_str:
+        if df[name].dtype == object and \
+                pd.api.types.infer_dtype(df[name], skipna=True) not in ('string', 'empty'):
+            df[name] = _to_str(df[name])
+            converted.add(name)
+
+    # Only flat string column names and string object columns are stored exactly
+    for name in df.columns:
+        if not isinstance(name, (str, type(u''))):
+            raise ValueError('cannot store column name %r (names must be strings)' % (name,))
+        values = df[name]
+        if not (pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values)) \
+                and pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty', 'categorical'):
+            raise ValueError('cannot store column %s of %s values (only numbers and strings)'
+                             % (name, pd.api.types.infer_dtype(values, skipna=True)))
+
+    # Encode columns
+    arrays, columns = [], []
+    for ii, name in enumerate(df.columns):
+        values = df[name]
+        col = {'name': name, 'file': 'c%04d.npy' % ii}
+        if name in converted:
+            col['converted'] = 'str'
+        if pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values):
+            arrays.append(np.asarray(values.values))
+            col['kind'] = 'numeric'
+        else:
+            codes, uniques = pd.factorize(values.astype(object), sort=True)
+            arrays.append(codes.astype(np.int32))
+            col['kind'] = 'category'
+            col['categories'] = 'c%04d.categories.npy' % ii
+            col['values'] = np.array([u'%s' % (u,) for u in uniques], dtype='U')
+        columns.append(col)
+
+    # Partition rows into groups
+    names = [c['name'] for c in columns]
+    if group_by:
+        keys = [arrays[names.index(c)] for c in group_by]
+        order = np.lexsort(keys[::-1])
+        sorted_keys = np.column_stack([k[order] for k in keys])
+        breaks = np.flatnonzero(np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)) + 1
+        starts = np.r_[0, breaks]
+        stops = np.r_[breaks, len(order)]
+    else:
+        order = np.arange(len(df))
+        starts, stops = np.array([0]), np.array([len(df)])
+    starts, stops = starts[stops > starts], stops[stops > starts]
+
+    groups = []
+    for start, stop in zip(starts, stops):
+        key = []
+        for c in group_by:
+            col = columns[names.index(c)]
+            value = arrays[names.index(c)][order[start]]
+            if col['kind'] == 'category':
+                value = col['values'][value] if value >= 0 else None
+            key.append(_as_python(value))
+        groups.append([key, int(start), int(stop)])
+
+    # Write to a temporary directory and move it in place
+    tmp = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for col, arr in zip(columns, arrays):
+        np.save(os.path.join(tmp, col['file']), np.ascontiguousarray(arr[order]))
+        if col['kind'] == 'category':
+            np.save(os.path.join(tmp, col['categories']), col.pop('values'))
+    np.save(os.path.join(tmp, 'row.npy'), order.astype(np.int64))
+
+    meta = {
+        'version': VERSION,
+        'nrows': len(df),
+        'columns': columns,
+        'group_by': group_by,
+        'groups': groups,
+        'source': source
+    }
+    with open(_meta_path(tmp), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def _filter_values(value):
+    if isinstance(value, (list, tuple, set, np.ndarray, pd.Index)):
+        return list(value)
+    return [value]
+
+def _row_groups(meta, filters):
+    """
+    Select the row groups whose keys pass the filters
+    """
+    group_by = meta['group_by']
+    wanted = dict((k, set(_filter_values(v))) for k, v in filters.items() if k in group_by)
+    if not wanted:
+        return [(0, meta['nrows'])]
+    selected = []
+    for key, start, stop in meta['groups']:
+        if all(key[group_by.index(k)] in v for k, v in wanted.items()):
+            if selected and selected[-1][1] == start:
+                selected[-1] = (selected[-1][0], stop)
+            else:
+                selected.append((start, stop))
+    return selected
+
+def _load_column(path, col, slices, categorical):
+    """
+    Read the selected row slices of a single column
+    """
+    arr = np.load(os.path.join(path, col['file']), mmap_mode='r')
+    values = np.concatenate([arr[a:b] for a, b in slices]) if slices else arr[:0].copy()
+    if col['kind'] == 'numeric':
+        return values
+    categories = np.load(os.path.join(path, col['categories']))
+    if categorical:
+        return pd.Categorical.from_codes(values, categories)
+    out = np.empty(len(values), dtype=object)
+    out[:] = categories.astype(object)[values]
+    out[values < 0] = np.nan
+    return out
+
+def read_table(path, columns=None, filters=None, categories=CATEGORIES):
+    """
+    Read a cached table, loading only the requested columns and row groups
+
+    Input
+    -----
+      path : cache directory
+      columns : list of columns to load (default: all)
+      filters : dict of column -> value or list of values. Filters on
+          the row-group keys skip whole groups without reading them;
+          other filters are applied to the loaded rows.
+      categories : columns to return as pandas categoricals
+
+    Output
+    -----
+      pandas dataframe in the original row order
+    """
+    meta = read_meta(path)
+    filters = filters or {}
+    by_name = dict((c['name'], c) for c in meta['columns'])
+    names = [c['name'] for c in meta['columns']] if columns is None else list(columns)
+    for name in list(names) + list(filters):
+        if name not in by_name:
+            raise KeyError('column %s not in %s' % (name, path))
+
+    slices = _row_groups(meta, filters)
+
+    # Restore the original row order within the selected groups
+    row = _load_column(path, {'file': 'row.npy', 'kind': 'numeric'}, slices, False)
+    order = np.argsort(row, kind='mergesort')
+
+    # Apply filters on the remaining columns
+    mask = np.ones(len(row), dtype=bool)
+    for name, value in filters.items():
+        if name in meta['group_by']:
+            continue
+        col = by_name[name]
+        values = _load_column(path, col, slices, False)
+        mask &= pd.Series(values).isin(_filter_values(value)).values
+    order = order[mask[order]]
+
+    data = pd.DataFrame(index=np.arange(len(order)))
+    for name in names:
+        values = _load_column(path, by_name[name], slices, name in categories)
+        data[name] = values[order]
+
+    return data
+
+def is_fresh(path, source):
+    """
+    Check whether the cache exists and was built from the given source
+    """
+    if not os.path.exists(_meta_path(path)):
+        return False
+    meta = read_meta(path)
+    return meta.get('version') == VERSION and meta.get('source') == source
+
+def read_csv(fn, columns=None, filters=None, cache_dir=None, group_by=GROUP_BY, categories=CATEGORIES, **kwargs):
+    """
+    Read a CSV file through the columnar cache
+
+    The first call parses the CSV with pandas and builds the cache next
+    to it (or in `cache_dir`). Later calls read the binary columns
+    directly, as long as the source file and the parser arguments are
+    unchanged. Columns parsed as a mix of numbers and strings (as pandas
+    does for large files read in chunks) are stored as strings; pass
+    `dtype` or `low_memory=False` to parse them consistently instead.
+
+    Input
+    -----
+      fn : CSV filename (optionally gzipped)
+      columns : list of columns to load (default: all)
+      filters : dict of column -> value or list of values
+      cache_dir : directory holding the cache (default: next to `fn`)
+      group_by : columns used to partition the rows
+      categories : columns to return as pandas categoricals
+      kwargs : arguments to pandas.read_csv
+    """
+    kwargs = utils.merge_two_dicts(READ_CSV, kwargs)
+    if cache_dir is None:
+        path = fn + '.cache'
+    else:
+        path = os.path.join(cache_dir, os.path.basename(fn) + '.cache')
+
+    source = source_stamp(fn, kwargs)
+    source['group_by'] = list(group_by)
+    if not is_fresh(path, source):
+        df = pd.read_csv(fn, **kwargs)
+        write_table(df, path, group_by=group_by, source=source,
+                    to_str=[c for c in df.columns if df[c].dtype == object])
+
+    return read_table(path, columns=columns, filters=filters, categories=categories)
@@ -7,20 +7,134 @@ Gaussian mixture model
 
 # Load external dependencies
 from setup import *
+import os, hashlib, tempfile
+from multiprocessing import Pool
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 # Load internal dependencies
 from sklearn.mixture import GaussianMixture
 
-def gmm_fit(X, N):
+# Directory holding fitted models, keyed by data and settings
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'gmm')
+
+def _fit(args):
     """
-    Fit models with N range components
+    Fit one batch of initialisations for a given number of components
     """
-    models = [None for i in range(len(N))]
-    
-    for i in range(len(N)):
-        models[i] = GaussianMixture(N[i], n_init=100).fit(X)
-        
+    key, X, n, n_init, seed = args
+    model = GaussianMixture(n, n_init=n_init, random_state=seed).fit(X)
+    return key, n, model
+
+def _cache_key(X, N, n_init, seed):
+    """
+    Hash of the input array and the fit settings
+    """
+    import sklearn
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    h = hashlib.sha1(X.tobytes())
+    h.update(repr((X.shape, list(N), n_init, seed, sklearn.__version__)).encode('utf-8'))
+    return h.hexdigest()
+
+def gmm_fit_many(data, N, n_init=100, batch=10, seed=0, processes=None, cache_dir=None, cache=True):
+    """
+    Fit models with N range components to several datasets at once
+
+    The component counts, batches of initialisations and datasets are
+    spread across a process pool; a single dataset (e.g. one histogram
+    panel) is fitted in-process, without starting a pool. For each
+    component count, the fit with the highest lower bound across batches
+    is kept, as GaussianMixture does with `n_init`. Fitted models are
+    cached on disk.
+
+    Input
+    -----
+      data : dict of key -> array of shape (n_samples, n_features)
+      N : list of component counts
+      n_init : number of initialisations per component count
+      batch : number of initialisations fitted per job
+      seed : base random seed (fits are reproducible)
+      processes : number of worker processes (default: number of cores
+          for several datasets, 1 for a single dataset); with 1, fits
+          run in-process
+      cache_dir : directory for cached models (default: CACHE_DIR)
+      cache : set to False to neither read nor write cached models
+
+    Output
+    -----
+      dict of key -> list of models, one per component count
+    """
+    N = [int(n) for n in N]
+    cache_dir = (CACHE_DIR if cache_dir is None else cache_dir) if cache else None
+    if processes is None and len(data) == 1:
+        processes = 1
+    models, paths, jobs = {}, {}, []
+    for key, X in data.items():
+        if cache_dir is not None:
+            paths[key] = os.path.join(cache_dir, _cache_key(X, N, n_init, seed) + '.pkl')
+            if os.path.exists(paths[key]):
+                with open(paths[key], 'rb') as f:
+                    models[key] = pickle.load(f)
+                continue
+        for n in N:
+            for ii, start in enumerate(range(0, n_init, batch)):
+                jobs.append((key, X, n, min(batch, n_init - start), seed + 1000*n + ii))
+
+    best = {}
+    def keep(fits):
+        for key, n, model in fits:
+            if (key, n) not in best or model.lower_bound_ > best[(key, n)].lower_bound_:
+                best[(key, n)] = model
+    if jobs and processes == 1:
+        keep(_fit(job) for job in jobs)
+    elif jobs:
+        pool = Pool(processes)
+        try:
+            keep(pool.imap_unordered(_fit, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+    for key in data:
+        if key in models:
+            continue
+        models[key] = [best[(key, n)] for n in N]
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # Write to a temporary file and rename it, so that a reader
+            # never finds a partly written model
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(models[key], f, protocol=-1)
+                os.replace(tmp, paths[key])
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
     return models
 
+def gmm_fit(X, N, **kwargs):
+    """
+    Fit models with N range components
+    """
+    return gmm_fit_many({0: X}, N, **kwargs)[0]
+
+def gmm_select(X, models):
+    """
+    Return the model with the lowest BIC
+    """
+    BIC = [m.bic(X) for m in models]
+    return models[np.argmin(BIC)]
+
+def gmm_best(X, N, **kwargs):
+    """
+    Fit models with N range components and return the BIC-selected model
+    """
+    return gmm_select(X, gmm_fit(X, N, **kwargs))
+
 def gmm_plot(ax, X, M_best, label=None):
     """
     Learn the best-fit GMM models
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Forward-backward smoothing of SNV read counts along the genome, as in filterHD
+"""
+
+# Load external dependencies
+from setup import *
+import sys
+from scipy.special import gammaln
+# Load internal dependencies
+import tracks
+
+# Number of frequency bins (as filterHD --grid)
+GRID = 100
+
+# Random-walk and jump parameters used where the options do not fix
+# them (filterHD learns these; here they stay fixed)
+SIGMA = 1e-4
+JUMP = 1e-3
+
+def parse_options(options):
+    """
+    Parameters of a filterHD command line (see `subclonality.LAYOUTS`)
+
+    Fixed values (--jump, --sigma) and initial values of learnt
+    parameters (--jumpi, --sigmai) are both taken as fixed. Only the
+    binomial mode (--mode 1) is supported. Output options such as --dist
+    (print the posterior distribution) have no counterpart here and are
+    ignored.
+
+    Input
+    -----
+      options : string, e.g. '--mode 1 --rnd 1e-8 --jump 0 --dist 1'
+
+    Output
+    -----
+      dict of jump, sigma, rnd and grid
+    """
+    args = options.split() if isinstance(options, str) else list(options)
+    values = dict(zip(args[::2], args[1::2]))
+    if int(values.get('--mode', 1)) != 1:
+        raise ValueError('only binomial read counts (--mode 1) are supported')
+    return {
+        'jump': float(values.get('--jump', values.get('--jumpi', JUMP))),
+        'sigma': float(values.get('--sigma', values.get('--sigmai', SIGMA))),
+        'rnd': float(values.get('--rnd', 0)),
+        'grid': int(values.get('--grid', GRID))
+    }
+
+def log_emission(reads, depth, x, rnd=0):
+    """
+    Log-probability of the read counts at each frequency of the grid
+
+    With `rnd` > 0, a read count is drawn uniformly at random from 0 to
+    the depth with that probability, as for filterHD --rnd.
+
+    Input
+    -----
+      reads, depth : arrays of read counts and depth, of shape (samples, loci)
+      x : grid of frequencies
+      rnd : probability of a random emission
+
+    Output
+    -----
+      array of shape (samples, loci, grid)
+    """
+    k = np.asarray(reads, dtype=float)[..., None]
+    n = np.asarray(depth, dtype=float)[..., None]
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore'):
+        lx, ly = np.log(x), np.log1p(-x)
+    # k log(x) + (n-k) log(1-x), with 0 log(0) = 0
+    e = k * np.where(x > 0, lx, 0) + (n - k) * np.where(x < 1, ly, 0)
+    e[..., x == 0] = np.where(k > 0, -np.inf, e[..., x == 0])
+    e[..., x == 1] = np.where(n > k, -np.inf, e[..., x == 1])
+    e += gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+    if rnd > 0:
+        e = np.logaddexp(np.log1p(-rnd) + e, np.log(rnd) - np.log(n + 1))
+    return e
+
+def _basis(size):
+    """
+    Orthonormal cosine basis of a grid with reflecting ends, and the
+    eigenvalues of its discrete Laplacian
+    """
+    k = np.arange(size)
+    V = np.cos(np.pi * np.outer(np.arange(size) + 0.5, k) / size)
+    V /= np.sqrt((V ** 2).sum(axis=0))
+    eig = 4 * np.sin(np.pi * k / (2. * size)) ** 2
+    return V, eig
+
+def transition_spectrum(loci, size, jump, sigma, per_bp=False):
+    """
+    Transition between consecutive loci, in the cosine basis of the grid
+
+    Between loci, the frequency follows a random walk of step `sigma`,
+    reflected at 0 and 1, or with probability `jump` jumps to a uniformly
+    random frequency. With `per_bp`, both scale with the distance in bp:
+    the variance of the walk is sigma^2 times the distance and the jump
+    probability is 1 - exp(-jump * distance). Both keep the uniform
+    mode, so each transition is a diagonal matrix in this basis.
+
+    Output
+    -----
+      tuple (basis of shape (grid, grid), array of shape (loci, grid)
+      with the multiplier of each mode before each locus; the first row
+      is unused)
+    """
+    V, eig = _basis(size)
+    d = np.ones(len(loci))
+    if per_bp and len(loci) > 1:
+        d[1:] = np.maximum(np.diff(np.asarray(loci, dtype=float)), 0)
+    h = 1. / (size - 1)
+    var = (sigma ** 2) * d / h ** 2
+    p = -np.expm1(-jump * d) if per_bp else np.full(len(d), jump)
+    m = (1 - p)[:, None] * np.exp(-0.5 * var[:, None] * eig[None, :])
+    m[:, 0] = 1
+    return V, m
+
+def forward_backward(reads, depth, loci=None, jump=JUMP, sigma=SIGMA, rnd=0, per_bp=False, grid=GRID):
+    """
+    Posterior frequency of one chromosome, for many samples at once
+
+    Emissions are computed in log space and rescaled at each locus; the
+    log of the scale factors adds up to the log-likelihood. Each step of
+    the forward and backward pass is a pair of (samples x grid) matrix
+    products.
+
+    Input
+    -----
+      reads, depth : arrays of read counts and depth, of shape
+          (samples, loci), with loci sorted by position
+      loci : positions in bp (needed with `per_bp`)
+      jump, sigma, rnd : parameters, as in filterHD (see `parse_options`)
+      per_bp : scale the transitions with the distance between loci
+          (see `transition_spectrum`); by default they are per locus
+      grid : number of frequency bins
+
+    Output
+    -----
+      tuple (grid of frequencies, posterior of shape (samples, loci,
+      grid+1), log-likelihood of each sample)
+    """
+    reads = np.atleast_2d(reads)
+    depth = np.atleast_2d(depth)
+    n_samples, n_loci = reads.shape
+    x = np.linspace(0, 1, grid + 1)
+    loci = np.arange(n_loci) if loci is None else loci
+    V, m = transition_spectrum(loci, len(x), jump, sigma, per_bp)
+    post = np.empty((n_samples, n_loci, len(x)))
+    llh = np.zeros(n_samples)
+    if n_loci == 0:
+        return x, post, llh
+
+    e = log_emission(reads, depth, x, rnd)
+    c = e.max(axis=-1, keepdims=True)
+    e = np.exp(e - c)
+
+    # Forward pass: post holds the filtered distributions
+    z = np.empty((n_samples, n_loci))
+    a = np.full((n_samples, len(x)), 1. / len(x))
+    for l in range(n_loci):
+        if l > 0:
+            a = np.maximum(np.dot(np.dot(a, V) * m[l], V.T), 0)
+        a = a * e[:, l]
+        z[:, l] = a.sum(axis=1)
+        a /= z[:, l, None]
+        post[:, l] = a
+    llh = (np.log(z) + c[..., 0]).sum(axis=1)
+
+    # Backward pass, with the same scale factors
+    b = np.ones((n_samples, len(x)))
+    for l in range(n_loci - 2, -1, -1):
+        b = np.maximum(np.dot(np.dot(b * e[:, l + 1], V) * m[l + 1], V.T), 0) / z[:, l + 1, None]
+        post[:, l] *= b
+    post /= post.sum(axis=-1, keepdims=True)
+    return x, post, llh
+
+def smooth(track, jump=JUMP, sigma=SIGMA, rnd=0, per_bp=False, grid=GRID):
+    """
+    Posterior mean and standard deviation of the frequency of every
+    sample along the genome, chromosome by chromosome
+
+    Input
+    -----
+      track : `tracks.Track` of read counts, with value columns (reads,
+          depth) for each sample, e.g. from mixture.snv.txt
+      jump, sigma, rnd, per_bp, grid : see `forward_backward`
+
+    Output
+    -----
+      tuple (pandas dataframe with columns chr_arabic, pos, and mean-i
+      and std-i of each sample i = 1, 2, ..., log-likelihood of each
+      sample)
+    """
+    values = track.values
+    if values.shape[1] % 2:
+        raise ValueError('expected (reads, depth) columns for each sample, got %d columns' % values.shape[1])
+    n_samples = values.shape[1] // 2
+    mean = np.empty((len(track), n_samples))
+    std = np.empty((len(track), n_samples))
+    llh = np.zeros(n_samples)
+    start = 0
+    for chrom in track.chromosomes():
+        t = track.region(chrom)
+        counts = np.asarray(t.values).T
+        x, post, l = forward_backward(counts[0::2], counts[1::2], np.asarray(t.locus),
+                                      jump=jump, sigma=sigma, rnd=rnd, per_bp=per_bp, grid=grid)
+        mu = np.dot(post, x)
+        stop = start + len(t)
+        mean[start:stop] = mu.T
+        std[start:stop] = np.sqrt(np.maximum(np.dot(post, x ** 2) - mu ** 2, 0)).T
+        llh += l
+        start = stop
+
+    df = pd.DataFrame({'chr_arabic': np.asarray(track.chrom), 'pos': np.asarray(track.locus)},
+                      columns=['chr_arabic', 'pos'])
+    for ii in range(n_samples):
+        df['mean-%d' % (ii + 1)] = mean[:, ii]
+        df['std-%d' % (ii + 1)] = std[:, ii]
+    return df, llh
+
+def smooth_file(fn, options='--mode 1', **kwargs):
+    """
+    Smooth a filterHD input track (e.g. snv_T2_T32.txt or mixture.snv.txt)
+    with the parameters of a filterHD command line
+
+    Input
+    -----
+      fn : track filename, read through its binary copy (see `tracks.read_track`)
+      options : filterHD options (see `parse_options`)
+      kwargs : parameters overriding the options, and `per_bp`
+
+    Output
+    -----
+      see `smooth`
+    """
+    params = parse_options(options)
+    params.update(kwargs)
+    return smooth(tracks.read_track(fn), **params)
+
+if __name__ == '__main__':
+    import argparse
+    import subclonality
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('data', help='track of read counts, as passed to filterHD --data')
+    parser.add_argument('--options', default=subclonality.LAYOUTS['experiment']['filterHD_mixture'],
+                        help='filterHD options (default: %(default)s)')
+    parser.add_argument('--pre', default=None,
+                        help='write the posterior mean and std to <pre>.posterior.txt')
+    parser.add_argument('--per-bp', action='store_true',
+                        help='scale the jump probability and random-walk variance with the distance between loci')
+    args = parser.parse_args()
+
+    df, llh = smooth_file(args.data, args.options, per_bp=args.per_bp)
+    if args.pre is not None:
+        df.to_csv(args.pre + '.posterior.txt', sep='\t', header=False, index=False, float_format='%.6g')
+    for ii, l in enumerate(llh):
+        sys.stdout.write('sample %d: llh = %.6g\n' % (ii + 1, l))
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming VCF ingestion for the background and de novo variant tables
+"""
+
+# Load external dependencies
+from setup import *
+import os
+from multiprocessing import Pool
+# Load internal dependencies
+import utils
+
+# Columns written for each variant call
+COLUMNS = ['sample', 'chr_arabic', 'pos', 'ref', 'alt',
+           'dp', 'dp_alt', 'dp_ref', 'frequency', 'genotype', 'consequence']
+
+# Non-nuclear chromosome names, numbered as in config.chrom_len
+CHROM_NAMES = {'mt': 17, 'm': 17, 'mito': 17, '2-micron': 18}
+
+def chrom_to_arabic(chrom):
+    """
+    Convert a VCF chromosome name (e.g. 'chrIV', 'IV', '4', 'chrmt') to
+    the arabic chromosome number
+    """
+    name = chrom[3:] if chrom.lower().startswith('chr') else chrom
+    if name.lower() in CHROM_NAMES:
+        return CHROM_NAMES[name.lower()]
+    if name.isdigit():
+        return int(name)
+    return utils.roman_to_int(name.upper())
+
+def sample_vcfs(fn, vcf_dir):
+    """
+    List the background and de novo VCF files of every sample
+
+    Input
+    -----
+      fn : sample table with a `ftp_submission_variants` column
+           (e.g. sample_ids_merged_dup.csv)
+      vcf_dir : local directory holding the downloaded VCF files
+
+    Output
+    -----
+      pandas dataframe with columns sample, type ('background' or 'de_novo') and path
+    """
+    df = pd.read_csv(fn, encoding='utf-8', keep_default_na=False)
+    rows = []
+    for sample, files in zip(df['sample'], df['ftp_submission_variants']):
+        for url in files.split(';'):
+            name = os.path.basename(url)
+            if not name.endswith('.vcf.gz'):
+                continue
+            kind = name[:-len('.vcf.gz')].rsplit('.', 1)[-1]
+            rows.append((sample, kind, os.path.join(vcf_dir, name)))
+    return pd.DataFrame(rows, columns=['sample', 'type', 'path'])
+
+def _csq_fields(reader):
+    """
+    Field names of the VEP consequence annotation, if present
+    """
+    if 'CSQ' not in reader.infos:
+        return None
+    desc = reader.infos['CSQ'].desc
+    return desc.split('Format:')[-1].strip().split('|')
+
+def stream_variants(fn, sample=None):
+    """
+    Stream variant calls from a VCF file, keeping only the fields used
+    by the variant tables
+
+    Input
+    -----
+      fn : VCF filename (optionally bgzipped)
+      sample : name of the sample column (default: first sample)
+
+    Output
+    -----
+      generator of tuples ordered as `COLUMNS`
+    """
+    import vcf
+
+    reader = vcf.Reader(filename=fn)
+    if sample is None:
+        sample = reader.samples[0]
+    csq = _csq_fields(reader)
+    consequence = csq.index('Consequence') if csq and 'Consequence' in csq else None
+
+    for record in reader:
+        call = record.genotype(sample)
+        data = call.data
+        ad = getattr(data, 'AD', None)
+        if ad is None:
+            dp_ref, dp_alt = np.nan, np.nan
+        else:
+            dp_ref, dp_alt = float(ad[0] or 0), float(sum(a or 0 for a in ad[1:]))
+        depth = dp_ref + dp_alt
+        frequency = dp_alt / depth if depth > 0 else np.nan
+        if consequence is not None and 'CSQ' in record.INFO:
+            effect = record.INFO['CSQ'][0].split('|')[consequence]
+        else:
+            effect = ''
+        yield (sample, chrom_to_arabic(record.CHROM), record.POS,
+               record.REF, ','.join(str(a) for a in record.ALT),
+               record.INFO.get('DP', np.nan), dp_alt, dp_ref, frequency,
+               getattr(data, 'GT', None) or '', effect)
+
+def _chunks(records, chunksize):
+    """
+    Group a stream of records into dataframes of at most `chunksize` rows
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunksize:
+            yield pd.DataFrame(chunk, columns=COLUMNS)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=COLUMNS)
+
+def ingest_vcf(args):
+    """
+    Convert one VCF file into a CSV table, writing it in chunks
+
+    Input
+    -----
+      args : tuple (sample, VCF filename, output filename, chunksize)
+
+    Output
+    -----
+      tuple (sample, output filename, number of variant calls)
+    """
+    sample, fn, out, chunksize = args
+    tmp = out + '.tmp'
+    n = 0
+    header = True
+    with open(tmp, 'w') as f:
+        for chunk in _chunks(stream_variants(fn), chunksize):
+            chunk['sample'] = sample
+            chunk.to_csv(f, header=header, index=False)
+            header = False
+            n += len(chunk)
+        if header:
+            pd.DataFrame(columns=COLUMNS).to_csv(f, index=False)
+    os.rename(tmp, out)
+    return sample, out, n
+
+def ingest(vcfs, out_dir, processes=None, chunksize=10**5):
+    """
+    Convert VCF files into per-sample CSV tables in a process pool
+
+    Input
+    -----
+      vcfs : dataframe of sample, type and path (see `sample_vcfs`)
+      out_dir : output directory
+      processes : number of worker processes (default: number of cores)
+      chunksize : number of variant calls held in memory per worker
+
+    Output
+    -----
+      dataframe of sample, type, output filename and number of calls
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    jobs = []
+    for sample, kind, path in zip(vcfs['sample'], vcfs['type'], vcfs['path']):
+        out = os.path.join(out_dir, '%s.%s.csv' % (sample, kind))
+        jobs.append((sample, path, out, chunksize))
+    kinds = dict((job[2], kind) for job, kind in zip(jobs, vcfs['type']))
+
+    pool = Pool(processes)
+    try:
+        results = list(pool.imap_unordered(ingest_vcf, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+    df = pd.DataFrame(results, columns=['sample', 'path', 'n_calls'])
+    df['type'] = df['path'].map(kinds)
+    return df[['sample', 'type', 'path', 'n_calls']].sort_values(['type', 'sample'])
+
+def concat_tables(fns, out, chunksize=10**5):
+    """
+    Concatenate per-sample tables into a single CSV file, chunk by chunk
+    """
+    header = True
+    with open(out, 'w') as f:
+        for fn in fns:
+            for chunk in pd.read_csv(fn, chunksize=chunksize, keep_default_na=False):
+                chunk.to_csv(f, header=header, index=False)
+                header = False
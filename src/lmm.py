@@ -8,6 +8,9 @@ Linear mixed model - Variance component analysis
 # Load external dependencies
 from setup import *
 from collections import defaultdict
+from multiprocessing import Pool
+from patsy import dmatrices
+from scipy import stats
 from statsmodels.formula.api import ols
 from statsmodels.stats.anova import anova_lm
     
@@ -18,12 +21,12 @@ def run_anova(factor_data, formula, anova_type=3):
 
 def fraction_of_explainable_variance(factor, anova):
     factors = [ each for each in anova.index if each != 'Residual' ]
-    num = anova.ix[factor]['sum_sq']
-    denom = anova.ix[factors]['sum_sq'].sum()
+    num = anova.loc[factor]['sum_sq']
+    denom = anova.loc[factors]['sum_sq'].sum()
     return num/denom
 
 def variance_explained(factor, anova):    
-    return anova.ix[factor]['sum_sq']/anova['sum_sq'].sum()
+    return anova.loc[factor]['sum_sq']/anova['sum_sq'].sum()
     
 def variance_vectors(factor_data, formula, var_func=variance_explained):
     results = defaultdict(list)
@@ -32,9 +35,254 @@ def variance_vectors(factor_data, formula, var_func=variance_explained):
     for factor in anova.index:
         results[('var_explained',factor)].append(var_func(factor, anova))
         results[('var_total',factor)].append(fraction_of_explainable_variance(factor, anova))
-        results[('df',factor)].append(anova.ix[factor]['df'])
-        results[('sum_sq',factor)].append(anova.ix[factor]['sum_sq'])
-        results[('mean_sq',factor)].append(anova.ix[factor]['mean_sq'])
-        results[('f_stat',factor)].append(anova.ix[factor]['F'])
-        results[('p_var',factor)].append(anova.ix[factor]['PR(>F)'])
+        results[('df',factor)].append(anova.loc[factor]['df'])
+        results[('sum_sq',factor)].append(anova.loc[factor]['sum_sq'])
+        results[('mean_sq',factor)].append(anova.loc[factor]['mean_sq'])
+        results[('f_stat',factor)].append(anova.loc[factor]['F'])
+        results[('p_var',factor)].append(anova.loc[factor]['PR(>F)'])
     return pd.DataFrame(results)
+
+def design_matrices(factor_data, formula):
+    """
+    Build the response vector and design matrix of a formula once
+
+    Output
+    -----
+      y : response vector
+      X : design matrix
+      terms : list of (term name, column slice), in formula order
+    """
+    y, X = dmatrices(formula, factor_data, return_type='matrix')
+    terms = list(X.design_info.term_name_slices.items())
+    return np.asarray(y).ravel(), np.asarray(X), terms
+
+def sequential_anova(y, X, terms, tol=1e-10):
+    """
+    Sequential (type I) ANOVA table from a design matrix
+
+    Each term is projected out after the terms before it, so the sums of
+    squares of all terms and the residual add up to the total sum of
+    squares. This is the table `anova_lm` returns by default.
+
+    Input
+    -----
+      y : response vector
+      X : design matrix
+      terms : list of (term name, column slice), in formula order
+      tol : relative tolerance for dropping collinear columns
+    """
+    n = len(y)
+    basis = np.zeros((n, 0))
+    resid = y.copy()
+    rows = []
+    for name, cols in terms:
+        Z = X[:, cols]
+        Z = Z - basis.dot(basis.T.dot(Z))
+        # Orthonormal basis of the part of the term not yet explained
+        U, s, _ = np.linalg.svd(Z, full_matrices=False)
+        U = U[:, s > tol * max(1., s.max() if len(s) else 0.)]
+        proj = U.T.dot(resid)
+        resid = resid - U.dot(proj)
+        basis = np.hstack([basis, U])
+        if name != 'Intercept':
+            rows.append((name, U.shape[1], proj.dot(proj)))
+
+    df_resid = n - basis.shape[1]
+    ss_resid = resid.dot(resid)
+    anova = pd.DataFrame(rows + [('Residual', df_resid, ss_resid)],
+                         columns=['factor', 'df', 'sum_sq']).set_index('factor')
+    anova['df'] = anova['df'].astype(float)
+    anova['mean_sq'] = anova['sum_sq'] / anova['df']
+    anova['F'] = anova['mean_sq'] / (ss_resid / df_resid)
+    anova['PR(>F)'] = stats.f.sf(anova['F'], anova['df'], df_resid)
+    anova.loc['Residual', ['F', 'PR(>F)']] = np.nan
+    return anova
+
+def _stratum_anova(args):
+    """
+    ANOVA table of one stratum
+    """
+    key, factor_data, formula = args
+    y, X, terms = design_matrices(factor_data, formula)
+    return key, sequential_anova(y, X, terms)
+
+def variance_components(data, formula, by=['selection','environment','type'], processes=None):
+    """
+    Variance components of a formula for every stratum of a table
+
+    The design matrix of each stratum is built once and the strata are
+    fitted in a process pool.
+
+    Input
+    -----
+      data : pandas dataframe
+      formula : patsy formula (e.g. 'norm_growth_rate ~ C(background) + C(gene)')
+      by : columns defining the strata
+      processes : number of worker processes (default: number of cores)
+
+    Output
+    -----
+      pandas dataframe with one row per stratum and factor, and columns
+      df, sum_sq, mean_sq, F, PR(>F), var_explained and var_total
+    """
+    jobs = [(key, group, formula) for key, group in data.groupby(by)]
+    pool = Pool(processes)
+    try:
+        results = pool.map(_stratum_anova, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    tables = []
+    for key, anova in results:
+        factors = [f for f in anova.index if f != 'Residual']
+        anova['var_explained'] = anova['sum_sq'] / anova['sum_sq'].sum()
+        anova['var_total'] = anova['sum_sq'] / anova.loc[factors, 'sum_sq'].sum()
+        anova = anova.reset_index()
+        key = key if isinstance(key, tuple) else (key,)
+        for name, value in zip(by, key):
+            anova[name] = value
+        tables.append(anova)
+
+    df = pd.concat(tables, ignore_index=True)
+    return df[list(by) + ['factor', 'df', 'sum_sq', 'mean_sq', 'F', 'PR(>F)', 'var_explained', 'var_total']]
+
+def _nested_rss(G, b, yy, ends):
+    """
+    Residual sums of squares of the nested models X[:, :e] for each e,
+    from batched normal equations
+
+    Input
+    -----
+      G : array (B, p, p) of X'WX
+      b : array (B, p) of X'Wy
+      yy : array (B,) of y'Wy
+      ends : last column (exclusive) of each nested model
+    """
+    rss = [yy]
+    for e in ends:
+        beta = np.einsum('bjk,bk->bj', np.linalg.pinv(G[:, :e, :e], rcond=1e-10), b[:, :e])
+        rss.append(yy - np.einsum('bj,bj->b', b[:, :e], beta))
+    return np.column_stack(rss)
+
+def _resample_batch(args):
+    """
+    Variance fractions of one batch of bootstrap or permutation replicates
+    """
+    y, X, terms, kind, size, seed = args
+    rng = np.random.RandomState(seed)
+    n = len(y)
+    if kind == 'observed':
+        w = np.ones((1, n))
+    elif kind == 'bootstrap':
+        # Resampling rows with replacement is a multinomial weighting
+        w = rng.multinomial(n, np.ones(n) / n, size=size).astype(float)
+    elif kind == 'permutation':
+        w = None
+    else:
+        raise ValueError('unknown resampling: %s' % kind)
+
+    if w is None:
+        Y = np.array([y[rng.permutation(n)] for _ in range(size)])
+        G = np.repeat(X.T.dot(X)[np.newaxis], size, axis=0)
+        b = Y.dot(X)
+        yy = np.repeat(y.dot(y), size)
+    else:
+        # One replicate at a time, so that only one weighted copy of X
+        # (n_rows x n_params) is held in memory
+        G = np.empty((len(w), X.shape[1], X.shape[1]))
+        for r in range(len(w)):
+            G[r] = (X.T * w[r]).dot(X)
+        b = (w * y).dot(X)
+        yy = (w * y * y).sum(axis=1)
+
+    ends = [cols.stop for _, cols in terms]
+    rss = _nested_rss(G, b, yy, ends)
+    ss = rss[:, :-1] - rss[:, 1:]
+    names = [name for name, _ in terms]
+    if 'Intercept' in names:
+        total = rss[:, names.index('Intercept') + 1]
+    else:
+        total = yy
+    factors = [ii for ii, name in enumerate(names) if name != 'Intercept']
+    ss = ss[:, factors]
+    var_explained = ss / total[:, np.newaxis]
+    var_total = ss / ss.sum(axis=1)[:, np.newaxis]
+    return np.hstack([var_explained, var_total])
+
+def resample_variance(factor_data, formula, kind='bootstrap', n_rep=1000, batch=100, seed=0, processes=None):
+    """
+    Bootstrap or permutation distribution of the variance fractions
+
+    Each replicate is a sequential least-squares decomposition, solved
+    for a whole batch of replicates at once through the normal equations
+    of the resampled design. Batches run in a process pool; each batch
+    has its own seed drawn from `seed`, so results do not depend on the
+    number of processes.
+
+    Input
+    -----
+      factor_data : pandas dataframe
+      formula : patsy formula
+      kind : 'bootstrap' (resample rows) or 'permutation' (shuffle the response)
+      n_rep : number of replicates
+      batch : number of replicates solved together
+      seed : random seed
+      processes : number of worker processes (default: number of cores)
+
+    Output
+    -----
+      pandas dataframe with one row per replicate and columns
+      ('var_explained', factor) and ('var_total', factor)
+    """
+    y, X, terms = design_matrices(factor_data, formula)
+    seeds = np.random.RandomState(seed).randint(2**31 - 1, size=(n_rep + batch - 1) // batch)
+    sizes = [min(batch, n_rep - ii * batch) for ii in range(len(seeds))]
+    jobs = [(y, X, terms, kind, size, s) for size, s in zip(sizes, seeds)]
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(_resample_batch, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    factors = [name for name, _ in terms if name != 'Intercept']
+    columns = pd.MultiIndex.from_product([['var_explained', 'var_total'], factors])
+    return pd.DataFrame(np.vstack(results), columns=columns)
+
+def variance_intervals(factor_data, formula, n_boot=1000, n_perm=1000, alpha=0.05, seed=0, **kwargs):
+    """
+    Point estimates, percentile bootstrap intervals and permutation
+    p-values of the variance fractions
+
+    Input
+    -----
+      factor_data : pandas dataframe
+      formula : patsy formula
+      n_boot : number of bootstrap replicates
+      n_perm : number of permutation replicates (0 to skip)
+      alpha : the intervals cover 1 - alpha
+      kwargs : arguments to `resample_variance`
+
+    Output
+    -----
+      pandas dataframe indexed by (measure, factor) with columns
+      estimate, ci_low, ci_high and p_perm
+    """
+    y, X, terms = design_matrices(factor_data, formula)
+    factors = [name for name, _ in terms if name != 'Intercept']
+    index = pd.MultiIndex.from_product([['var_explained', 'var_total'], factors])
+    estimate = pd.Series(_resample_batch((y, X, terms, 'observed', 1, seed))[0], index=index)
+
+    boot = resample_variance(factor_data, formula, kind='bootstrap', n_rep=n_boot, seed=seed, **kwargs)
+    df = pd.DataFrame({
+        'estimate': estimate,
+        'ci_low': boot.quantile(alpha / 2.),
+        'ci_high': boot.quantile(1 - alpha / 2.)
+    }, columns=['estimate', 'ci_low', 'ci_high'])
+
+    if n_perm:
+        perm = resample_variance(factor_data, formula, kind='permutation', n_rep=n_perm, seed=seed + 1, **kwargs)
+        df['p_perm'] = (1. + (perm >= estimate).sum()) / (1. + n_perm)
+    return df
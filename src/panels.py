@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Render cache for plot panels
+"""
+
+# Load external dependencies
+from setup import *
+import os, sys, glob, hashlib, inspect, functools, numbers, tempfile
+from matplotlib.backends.backend_agg import RendererAgg
+# Load internal dependencies
+
+# Directory holding rendered panels, keyed by content and view
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'panels')
+
+# Size cap of the cache directory; least recently used panels are evicted
+MAX_BYTES = 512 * 2**20
+
+# Set to True to cache the rendered panels of the decorated plot functions
+ENABLED = False
+
+# Artists that are drawn into the cached raster; text, ticks and the axes
+# frame are always drawn live
+RASTER_TYPES = (lines.Line2D, mpl.collections.Collection, patches.Patch, mpl.image.AxesImage)
+
+def _update_hash(h, value):
+    """
+    Feed a plot function argument into a hash
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(repr((type(value).__name__, value.shape,
+                       [list(i.names) for i in value.axes])).encode('utf-8'))
+        h.update(np.ascontiguousarray(pd.util.hash_pandas_object(value, index=True).values).tobytes())
+        if isinstance(value, pd.DataFrame):
+            h.update(np.ascontiguousarray(pd.util.hash_pandas_object(value.columns.to_frame(index=False),
+                                                                     index=False).values).tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(repr((value.dtype.str, value.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(np.ma.getdata(value)).tobytes())
+        if np.ma.isMaskedArray(value):
+            h.update(np.ascontiguousarray(np.ma.getmaskarray(value)).tobytes())
+    elif isinstance(value, mpl.path.Path):
+        _update_hash(h, value.vertices)
+        _update_hash(h, value.codes)
+    elif isinstance(value, mpl.colors.Colormap):
+        h.update(value.name.encode('utf-8'))
+        h.update(np.ascontiguousarray(value(np.linspace(0, 1, value.N))).tobytes())
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s%d' % (type(value).__name__, len(value))).encode('utf-8'))
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        for k in sorted(value, key=repr):
+            h.update(repr(k).encode('utf-8'))
+            _update_hash(h, value[k])
+    elif isinstance(value, (mpl.axes.Axes, mpl.gridspec.SubplotSpec, mpl.gridspec.GridSpecBase)):
+        # Axes are identified by the view at draw time
+        h.update(type(value).__name__.encode('utf-8'))
+    elif value is None or isinstance(value, (numbers.Number, np.generic, bool, str, bytes, type(u''))):
+        h.update(('%s:%r' % (type(value).__name__, value)).encode('utf-8'))
+    else:
+        # The repr of other objects may hold their memory address
+        raise TypeError('cannot hash %s arguments by content' % type(value).__name__)
+
+def content_key(func, args, kwargs):
+    """
+    Hash of a plot function, of the source of its module and of its
+    arguments
+    """
+    h = hashlib.sha1()
+    h.update(('%s.%s' % (func.__module__, func.__name__)).encode('utf-8'))
+    h.update(inspect.getsource(sys.modules[func.__module__]).encode('utf-8'))
+    h.update(repr(sorted((k, repr(v)) for k, v in mpl.rcParams.items())).encode('utf-8'))
+    h.update(mpl.__version__.encode('utf-8'))
+    _update_hash(h, list(args))
+    _update_hash(h, kwargs)
+    return h.hexdigest()
+
+def _path(key, cache_dir):
+    return os.path.join(cache_dir, key + '.npz')
+
+# Prefix of images being written (never evicted)
+TMP_PREFIX = '.tmp-'
+
+def load(key, cache_dir=None):
+    """
+    Cached RGBA image of a panel, or None
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    fn = _path(key, cache_dir)
+    if not os.path.exists(fn):
+        return None
+    try:
+        with np.load(fn) as f:
+            img = f['image']
+    except Exception:
+        return None
+    try:
+        os.utime(fn, None) # mark as recently used
+    except OSError:
+        pass
+    return img
+
+def store(key, img, cache_dir=None, max_bytes=None):
+    """
+    Write a panel image to the cache and evict the least recently used
+    panels above `max_bytes`
+
+    Each writer uses its own temporary file, so that processes saving
+    the same figure in several formats can store the same panel at once.
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, suffix='.npz', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, image=img)
+        os.replace(tmp, _path(key, cache_dir))
+    except OSError:
+        # Lost a race with another writer or with eviction: not cached
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    evict(cache_dir, max_bytes)
+
+def evict(cache_dir=None, max_bytes=None):
+    """
+    Delete the least recently used panels until the cache fits in `max_bytes`
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for fn in glob.glob(os.path.join(cache_dir, '*.npz')):
+        if os.path.basename(fn).startswith(TMP_PREFIX):
+            continue
+        try:
+            st = os.stat(fn)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, fn))
+    total = sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+        total -= size
+
+def clear(cache_dir=None):
+    """
+    Delete all cached panels
+    """
+    evict(cache_dir, 0)
+
+
+# Artist properties that change what a layer looks like, read through
+# their getters (get_<name>) where the artist has one
+STATE = ('visible', 'alpha', 'color', 'facecolor', 'edgecolor', 'linewidth', 'linestyle',
+         'drawstyle', 'marker', 'markersize', 'markerfacecolor', 'markeredgecolor',
+         'xydata', 'offsets', 'paths', 'verts', 'hatch', 'array', 'clim', 'cmap',
+         'extent', 'interpolation')
+
+class CachedLayer(object):
+    """
+    Cached raster of the artists of one axes at one zorder
+
+    The artists stay in the axes as they are, so that data limits,
+    legends and later changes to the artists behave as without the
+    cache. Their `draw` is wrapped: the first artist of the layer drawn
+    pastes the image of the whole layer for the current view (axes
+    limits, size in pixels and dpi) and the current properties of the
+    artists (see `STATE`), and the others draw nothing. On a miss the
+    artists are rendered off screen, stored and pasted. Only the part of
+    the artists inside the axes is cached. Vector outputs (pdf, svg)
+    whose images are magnified (any dpi but 72) draw the artists live,
+    as the figure is laid out at 72 dpi.
+    """
+    def __init__(self, artists, key, cache_dir=None, max_bytes=None):
+        self.artists = list(artists)
+        self.key = key
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._draw = {}
+        for a in self.artists:
+            self._draw[a] = a.draw
+            a.draw = functools.partial(self._draw_artist, a)
+
+    def _members(self):
+        # Artists removed from the axes are dropped
+        return [a for a in self.artists if a.axes is not None]
+
+    def _view_key(self, axes, dpi):
+        view = (np.round(axes.viewLim.get_points(), 10).tolist(),
+                axes.get_xscale(), axes.get_yscale(),
+                np.round(np.asarray(axes.bbox.bounds), 3).tolist(),
+                float(dpi))
+        h = hashlib.sha1(self.key.encode('utf-8'))
+        h.update(repr(view).encode('utf-8'))
+        for a in self._members():
+            for name in STATE:
+                getter = getattr(a, 'get_' + name, None)
+                if getter is not None:
+                    h.update(name.encode('utf-8'))
+                    _update_hash(h, getter())
+        return h.hexdigest()
+
+    def _render(self, axes, dpi):
+        """
+        Draw the artists off screen and crop them to the axes
+        """
+        fig = axes.figure
+        width, height = int(np.ceil(fig.bbox.width)), int(np.ceil(fig.bbox.height))
+        renderer = RendererAgg(width, height, dpi)
+        for a in self._members():
+            self._draw[a](renderer)
+        x0, y0, x1, y1 = axes.bbox.extents
+        left, right = int(np.floor(x0)), int(np.ceil(x1))
+        bottom, top = int(np.floor(y0)), int(np.ceil(y1))
+        buf = np.asarray(renderer.buffer_rgba())
+        # Rows from the bottom up, as expected by draw_image
+        img = buf[max(height - top, 0):height - bottom, max(left, 0):right][::-1].copy()
+        return img, (left, bottom)
+
+    def _draw_artist(self, artist, renderer):
+        members = self._members()
+        if not members or artist is not members[0]:
+            return
+        axes = artist.axes
+        key = None
+        if renderer.get_image_magnification() == 1:
+            try:
+                key = self._view_key(axes, axes.figure.dpi)
+            except Exception:
+                # Properties that cannot be hashed: draw live
+                key = None
+        if key is None:
+            for a in members:
+                self._draw[a](renderer)
+            return
+        img = load(key, self.cache_dir)
+        if img is None:
+            img, (left, bottom) = self._render(axes, axes.figure.dpi)
+            store(key, img, self.cache_dir, self.max_bytes)
+        else:
+            x0, y0, _, _ = axes.bbox.extents
+            left, bottom = int(np.floor(x0)), int(np.floor(y0))
+        gc = renderer.new_gc()
+        gc.set_alpha(1.0)
+        renderer.draw_image(gc, left, bottom, img)
+        gc.restore()
+        for a in members:
+            a.stale = False
+
+
+def _figure(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, mpl.axes.Axes):
+            return value.figure
+    return plt.gcf()
+
+def _raster_children(ax):
+    skip = set([ax.patch]) | set(ax.spines.values())
+    return [a for a in ax.get_children()
+            if isinstance(a, RASTER_TYPES) and a not in skip and a.get_rasterized()]
+
+# Depth of nested cached calls (only the outermost call is cached)
+_depth = [0]
+
+def cached(func):
+    """
+    Decorator caching the rendered raster artists of a plot function
+
+    The function always runs in full, so that text, ticks and labels are
+    drawn live: a cache hit saves drawing time only, not the time spent
+    building the artists. The rasterized lines, collections, patches and
+    images it adds are grouped per axes and zorder into `CachedLayer`s,
+    keyed by a hash of the function and its arguments (including
+    dataframe contents). Artists drawn as vectors (rasterized=False, the
+    default) or outside the axes (clip_on=False) are left live, as are
+    all artists if an argument cannot be hashed by content. The cache is
+    off unless `ENABLED` is set.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED or _depth[0] > 0:
+            return func(*args, **kwargs)
+        fig = _figure(args, kwargs)
+        before = dict((ax, set(_raster_children(ax))) for ax in fig.axes)
+        _depth[0] += 1
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _depth[0] -= 1
+        try:
+            key = content_key(func, args, kwargs)
+        except Exception:
+            # Arguments that cannot be hashed: draw live
+            return result
+        for ii, ax in enumerate(fig.axes):
+            new = [a for a in _raster_children(ax) if a not in before.get(ax, ())
+                   and a.get_visible() and a.get_clip_on()]
+            zorders = sorted(set(a.get_zorder() for a in new))
+            for z in zorders:
+                layer = [a for a in new if a.get_zorder() == z]
+                CachedLayer(layer, '%s-%d-%s' % (key, ii, z))
+        return result
+    return wrapper
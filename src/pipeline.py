@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Data preparation pipeline shared by the figure notebooks
+
+Each derived table is a node with explicit inputs (CSV files or other
+nodes). A node is materialised once in the columnar cache and only
+recomputed when one of its input files, its own function or any
+upstream node changes.
+"""
+
+# Load external dependencies
+from setup import *
+import os, json, inspect, hashlib
+# Load internal dependencies
+import cache
+
+# Data directory, as set up for the notebooks
+DATA_DIR = dir_data
+
+# Directory holding materialised nodes
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'pipeline')
+
+NODES = {}
+
+class Node(object):
+    """
+    A table in the pipeline
+
+    Input
+    -----
+      name : node name
+      func : function computing the table from its inputs
+      inputs : names of upstream nodes, passed to `func` in order
+      fn : CSV filename, relative to DATA_DIR (source nodes only)
+      kwargs : arguments to pandas.read_csv (source nodes only)
+    """
+    def __init__(self, name, func=None, inputs=(), fn=None, kwargs=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.fn = fn
+        self.kwargs = kwargs or {}
+
+    def is_source(self):
+        return self.fn is not None
+
+def source(name, fn, **kwargs):
+    """
+    Declare a CSV file as a source node
+    """
+    NODES[name] = Node(name, fn=fn, kwargs=kwargs)
+
+def node(*inputs):
+    """
+    Decorator declaring a derived table computed from upstream nodes
+    """
+    def register(func):
+        NODES[func.__name__] = Node(func.__name__, func=func, inputs=inputs)
+        return func
+    return register
+
+def fingerprint(name, _memo=None):
+    """
+    Hash of a node's function and of everything upstream of it
+    """
+    memo = {} if _memo is None else _memo
+    if name in memo:
+        return memo[name]
+    n = NODES[name]
+    h = hashlib.sha1()
+    if n.is_source():
+        stamp = cache.source_stamp(os.path.join(DATA_DIR, n.fn), n.kwargs)
+        h.update(json.dumps(stamp, sort_keys=True).encode('utf-8'))
+    else:
+        h.update(inspect.getsource(n.func).encode('utf-8'))
+        for i in n.inputs:
+            h.update(fingerprint(i, memo).encode('utf-8'))
+    memo[name] = h.hexdigest()
+    return memo[name]
+
+def _to_long(df):
+    """
+    Flatten a (possibly wide) dataframe into a storable table
+
+    Output
+    -----
+      flat dataframe and its layout (row and column index names)
+    """
+    layout = {'index': None, 'columns': None}
+    if isinstance(df.columns, pd.MultiIndex):
+        layout['columns'] = list(df.columns.names)
+        layout['index'] = list(df.index.names)
+        df = df.stack(list(range(df.columns.nlevels))).dropna()
+        df = df.rename('value').reset_index()
+    elif any(name is not None for name in df.index.names):
+        layout['index'] = list(df.index.names)
+        df = df.reset_index()
+    else:
+        df = df.reset_index(drop=True)
+    return df, layout
+
+def _from_long(df, layout):
+    """
+    Restore the layout of a table flattened by `_to_long`
+    """
+    if layout['columns'] is not None:
+        keys = layout['index'] + layout['columns']
+        # Index levels hold plain values and columns are in sorted order, as from pd.pivot_table
+        for c in keys:
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype(df[c].cat.categories.dtype)
+        return df.set_index(keys)['value'].unstack(layout['columns']).sort_index(axis=1)
+    if layout['index'] is not None:
+        return df.set_index(layout['index'])
+    return df
+
+def _materialise(name, memo):
+    """
+    Compute a node if it is missing or stale, and return its cache path
+    """
+    n = NODES[name]
+    if n.is_source():
+        return None
+    fp = fingerprint(name, memo)
+    path = os.path.join(CACHE_DIR, name)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        stored = cache.read_meta(path).get('source') or {}
+        if stored.get('fingerprint') == fp:
+            return path
+
+    args = [_load(i, memo, categories=()) for i in n.inputs]
+    df, layout = _to_long(n.func(*args))
+    cache.write_table(df, path, source={'fingerprint': fp, 'layout': layout})
+    return path
+
+def _load(name, memo, columns=None, filters=None, categories=cache.CATEGORIES):
+    n = NODES[name]
+    if n.is_source():
+        return cache.read_csv(os.path.join(DATA_DIR, n.fn), columns=columns, filters=filters,
+                              categories=categories, **n.kwargs)
+    path = _materialise(name, memo)
+    layout = cache.read_meta(path)['source']['layout']
+    if layout['columns'] is not None:
+        columns = None
+    df = cache.read_table(path, columns=columns, filters=filters, categories=categories)
+    return _from_long(df, layout)
+
+def get(name, columns=None, filters=None, categories=cache.CATEGORIES):
+    """
+    Return a finished table, computing it and its upstream nodes if needed
+
+    Input
+    -----
+      name : node name
+      columns : list of columns to load (flat tables only)
+      filters : dict of column -> value or list of values
+      categories : columns to return as pandas categoricals
+    """
+    return _load(name, {}, columns=columns, filters=filters, categories=categories)
+
+def stale():
+    """
+    Names of the derived nodes that would be recomputed by `get`
+    """
+    memo = {}
+    names = []
+    for name, n in sorted(NODES.items()):
+        if n.is_source():
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        meta = os.path.join(path, 'meta.json')
+        stored = cache.read_meta(path).get('source') or {} if os.path.exists(meta) else {}
+        if stored.get('fingerprint') != fingerprint(name, memo):
+            names.append(name)
+    return names
+
+
+### Sources ###
+source('pheno_populations', 'pheno/populations/pheno_populations.csv.gz', na_values='NaN')
+source('pheno_genetic_cross_spores', 'pheno/genetic-cross/pheno_genetic_cross_spores.csv.gz', na_values='NaN')
+source('seq_de_novo_snv_indel', 'seq/de-novo/seq_de_novo_snv_indel.csv')
+source('seq_de_novo_cn_loh', 'seq/de-novo/seq_de_novo_cn_loh.csv.gz', dtype={'pos_cum': str})
+
+### Phenotypes ###
+@node('pheno_populations')
+def pheno_populations_filtered(df):
+    """
+    Ancestral and evolved isolates, with the ancestral isolates of each
+    cross repeated for every evolved population derived from it
+    """
+    # Filter out strains used for spatial control
+    df = df[(df.group == 'ancestral') | (df.group == 'evolved')]
+    keys = ['cross', 'cross_rep', 'selection']
+    evolved = df[df.selection_rep != '']
+    ancestral = df[(df.group == 'ancestral') & (df.selection_rep == '')]
+    reps = evolved[evolved.group == 'evolved'][keys + ['selection_rep']].drop_duplicates()
+    ancestral = ancestral.drop('selection_rep', axis=1).merge(reps, on=keys)
+    ancestral['population'] = ancestral['background']+'_'+ancestral['cross']+'_'+\
+        ancestral['cross_rep'].apply(str)+'_'+ancestral['selection']+'_'+ancestral['selection_rep'].apply(str)
+    return pd.concat([evolved, ancestral[evolved.columns]], ignore_index=True)
+
+@node('pheno_populations_filtered')
+def pheno_populations_relative(df):
+    """
+    Growth rates and doubling times relative to the mean of the
+    ancestral isolates of each population and environment
+    """
+    keys = ['selection', 'environment', 'population']
+    ancestral = df[df.group == 'ancestral']
+    for param in ['growth_rate', 'doubling_time']:
+        ref = ancestral.groupby(keys)['norm_' + param].mean().rename('ref').reset_index()
+        df['rel_' + param] = df['norm_' + param].values - df[keys].merge(ref, on=keys, how='left')['ref'].values
+    return df
+
+@node('pheno_genetic_cross_spores')
+def pheno_spores_filtered(df):
+    """
+    Spores without blank positions and constructs; contaminated samples
+    set as missing
+    """
+    df = df[~(df['strain'].isin(['control', ''])) &
+            ~(df['genotype_long'].isin([u'fpr1Δ', u'tor1Δ']))].copy()
+    df.loc[(df['contamination'] == 'yes'),
+           ['abs_growth_rate', 'abs_doubling_time', 'norm_growth_rate', 'norm_doubling_time']] = np.nan
+    return df
+
+### Genotypes ###
+@node('seq_de_novo_snv_indel')
+def seq_de_novo_drivers(df):
+    """
+    Frequency of driver mutations in each population, pivoted by locus
+    """
+    df = df[df.mutation_type == 'driver']
+    return pd.pivot_table(
+        df,
+        index=['selection', 'population'],
+        columns=['chr_arabic', 'chr_roman', 'pos', 'pos_cum', 'gene'],
+        values='frequency'
+    )
+
+@node('seq_de_novo_snv_indel')
+def seq_de_novo_clones(df):
+    """
+    SNV/indel genotypes of the sequenced clones (0: ref, 1: het, 2: hom)
+    """
+    df = df[df.clone != ''].reset_index(drop=True)
+    df['genotype'] = df['genotype'].map({'0': 0, '1': 2, '0/0': 0, '0/1': 1, '1/0': 1, '1/1': 2})
+    df['type'] = 'snv_indel'
+    return df
+
+@node('seq_de_novo_cn_loh')
+def seq_de_novo_cn_loh_numeric(df):
+    """
+    Copy number and LOH tracks with numeric genotypes and coordinates
+    """
+    df['genotype'] = pd.to_numeric(df['genotype'], errors='coerce')
+    df['pos_cum'] = pd.to_numeric(df['pos_cum'], errors='coerce')
+    return df
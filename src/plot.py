@@ -3,20 +3,29 @@
 
 # Load external dependencies
 from setup import *
+import time, bisect
+from multiprocessing import Pool
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 # Load internal dependencies
-import config, utils
+import config, utils, panels
 
 def histogram_binned_data(ax, data, bins=50):
     """
+    Step curve of the histogram of `data`, as the fraction of observations
+    in each bin (`bins` equal bins over the range of the data; NaNs are
+    ignored). `data` may also be a `utils.Histogram` accumulator.
     """
-    nx, xbins = np.histogram(data, bins=bins, normed=True)
-
-    nx_frac = nx/float(len(nx)) # Each bin divided by total number of objects
-    width = xbins[1] - xbins[0] # Width of each bin
-    x = np.ravel(zip(xbins[:-1], xbins[:-1]+width))
-    y = np.ravel(zip(nx_frac,nx_frac))
-    
-    return x, y
+    if isinstance(data, utils.Histogram):
+        return data.step()
+    data = np.asarray(data, dtype=float)
+    data = data[~np.isnan(data)]
+    lo, hi = (data.min(), data.max()) if len(data) else (0., 1.)
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    return utils.Histogram(bins, range=(lo, hi)).update(data).step()
 
 
 def boxplot_custom(bp, ax, colors, hatches):
@@ -73,18 +82,93 @@ def boxplot_custom(bp, ax, colors, hatches):
     ax.tick_params(axis='y', length=0)
     
 
-def heatmap(x, y, z, ax, title, xlabel, ylabel, xticklabels, yticklabels, cmap='RdBu', hatch='', vmin=0.0, vmax=1.0, show=False, speed='slow', zorder=1):
+def cell_runs(mask):
+    """
+    Runs of consecutive selected cells along each row of a matrix
+
+    Input
+    -----
+      mask : boolean array (rows x columns)
+
+    Output
+    -----
+      arrays of row, first column and last column + 1 of each run
+    """
+    mask = np.asarray(mask, dtype=bool)
+    padded = np.zeros((mask.shape[0], mask.shape[1]+2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    step = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(step == 1)
+    _, stops = np.nonzero(step == -1)
+    return rows, starts, stops
+
+def heatmap_raster(x, y, z, ax, cmap='RdBu', hatch='', vmin=0.0, vmax=1.0, zorder=1):
+    """
+    Heatmap drawn as a single image, for matrices with many cells
+
+    Cell edges may be irregular (e.g. `pos_cum` of each locus). Masked and
+    NaN cells are left transparent. With `hatch`, the unmasked cells are
+    overlaid with the hatch pattern, one rectangle per run of consecutive
+    cells in a row.
+
+    Input
+    -----
+      x, y : cell edges (len(x) = columns + 1, len(y) = rows + 1)
+      z : matrix of values, optionally masked
+      ax : matplotlib axes
+      cmap, vmin, vmax : color mapping, as in `pcolor`
+      hatch : hatch pattern of the overlay
+      zorder : drawing order
+    """
+    z = np.ma.masked_invalid(np.ma.asarray(z, dtype=float))
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    c = ax.pcolorfast(x, y, z, cmap=cmap, vmin=vmin, vmax=vmax, zorder=zorder)
+
+    if hatch:
+        # All runs form a single compound path, so that the hatch is
+        # filled in one pass
+        rows, starts, stops = cell_runs(~np.ma.getmaskarray(z))
+        verts = np.stack([np.column_stack([x[starts], y[rows]]),
+                          np.column_stack([x[stops], y[rows]]),
+                          np.column_stack([x[stops], y[rows+1]]),
+                          np.column_stack([x[starts], y[rows+1]]),
+                          np.column_stack([x[starts], y[rows]])], axis=1)
+        codes = np.tile([mpl.path.Path.MOVETO] + [mpl.path.Path.LINETO]*3 + [mpl.path.Path.CLOSEPOLY], len(rows))
+        overlay = patches.PathPatch(mpl.path.Path(verts.reshape(-1, 2), codes), hatch=hatch,
+                                    facecolor='none', edgecolor='none', linewidth=1,
+                                    rasterized=True, zorder=zorder)
+        ax.add_patch(overlay)
+
+    return c
+
+def heatmap(x, y, z, ax, title, xlabel, ylabel, xticklabels, yticklabels, cmap='RdBu', hatch='', vmin=0.0, vmax=1.0, show=False, speed='auto', zorder=1, raster_threshold=10000):
     """
     Inspired by:
     - http://stackoverflow.com/a/16124677/395857 
     - http://stackoverflow.com/a/25074150/395857
+
+    speed: 'slow' (pcolor), 'fast' (pcolormesh), 'raster' (single image,
+    see `heatmap_raster`) or 'auto' (raster above `raster_threshold`
+    cells when the edges are sorted, pcolor otherwise).
     """
+    if speed=='auto':
+        large = np.size(z) > raster_threshold
+        sorted_edges = np.all(np.diff(x) >= 0) and np.all(np.diff(y) >= 0)
+        speed = ('raster' if large and sorted_edges else 'slow')
+
     # Plot the heatmap
-    if speed=='slow':
-        c = ax.pcolor(x, y, z, linewidths=1, cmap=cmap, hatch=hatch, vmin=vmin, vmax=vmax, rasterized=True, zorder=zorder)
+    if speed in ['slow','raster']:
+        if speed=='slow':
+            c = ax.pcolor(x, y, z, linewidths=1, cmap=cmap, hatch=hatch, vmin=vmin, vmax=vmax, rasterized=True, zorder=zorder)
+        else:
+            c = heatmap_raster(x, y, z, ax, cmap=cmap, hatch=hatch, vmin=vmin, vmax=vmax, zorder=zorder)
     
-        # Place the major ticks at the middle of each cell
-        ax.set_xticks(np.arange(z.shape[1]) + 0.5, minor=False)
+        # Place the major ticks at the middle of each cell (skipped for
+        # unlabelled columns of large matrices, one tick per locus is slow)
+        if speed=='slow' or len(xticklabels) > 0:
+            ax.set_xticks(np.arange(z.shape[1]) + 0.5, minor=False)
+        else:
+            ax.set_xticks([])
         ax.set_yticks(np.arange(z.shape[0]) + 0.5, minor=False)
 
         # Set tick labels
@@ -139,6 +223,7 @@ def heatmap_spores(S, ax, title, xlabel, ylabel, xticklabels, yticklabels, fold=
     return dict_mat
 
 
+@panels.cached
 def heatmap_hybrids(H, ax, title, xlabel, ylabel, xticklabels, yticklabels, fold=False, cmap='RdBu', vmin=0.0, vmax=1.0, pad=0.25, legend_title=''):
     """
     
@@ -204,20 +289,157 @@ def heatmap_hybrids(H, ax, title, xlabel, ylabel, xticklabels, yticklabels, fold
     cbar.locator = ticker.MaxNLocator(nbins=3)
     cbar.outline.set_visible(False)
 	
-def gw_frequency(data, ax=None, **kwargs):
-    """
-    
+def decimate(x, y, xmin, xmax, n):
+    """
+    Min/max decimation of a line for display at a given pixel width
+
+    Input
+    -----
+      x : sorted x coordinates
+      y : y values (NaN breaks the line)
+      xmin, xmax : visible x range
+      n : number of buckets (e.g. the width of the axes in pixels)
+
+    Output
+    -----
+      x, y of at most four points per bucket: the first, minimum, maximum
+      and last points, in their original order. Points just outside the
+      visible range are kept so that lines reach the axes edges.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if np.any(np.diff(x) < 0):
+        raise ValueError('x must be sorted for decimation')
+    i = max(np.searchsorted(x, xmin, side='left') - 1, 0)
+    j = min(np.searchsorted(x, xmax, side='right') + 1, len(x))
+    x, y = x[i:j], y[i:j]
+    if len(x) <= 4 * n or xmax <= xmin:
+        return x, y
+
+    # Assign points to pixel buckets and find where each bucket starts
+    bucket = np.floor((x - xmin) / (xmax - xmin) * n).clip(-1, n).astype(np.int64)
+    starts = np.r_[0, np.flatnonzero(np.diff(bucket)) + 1]
+    stops = np.r_[starts[1:], len(x)] - 1
+    group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(x)]))
+
+    # Position of the first extreme of each bucket (the first point if
+    # the bucket only holds NaN)
+    def extreme(ufunc):
+        value = ufunc.reduceat(y, starts)
+        hit = np.flatnonzero(y == value[group])
+        pos = starts.copy()
+        first = np.r_[True, group[hit][1:] != group[hit][:-1]]
+        pos[group[hit][first]] = hit[first]
+        return pos
+
+    idx = np.sort(np.column_stack([starts, extreme(np.fmin), extreme(np.fmax), stops]), axis=1).ravel()
+    return x[idx], y[idx]
+
+
+class DecimatedLine(lines.Line2D):
+    """
+    Line that only draws the min/max of each pixel column of the axes
+
+    The full data are kept and reduced again whenever the x-limits or the
+    size of the axes in pixels change (e.g. when zooming or saving at a
+    different dpi), so that peaks and sweeps look the same as the full line.
+    """
+    def __init__(self, x, y, **kwargs):
+        self._x_full = np.asarray(x, dtype=float)
+        self._y_full = np.asarray(y, dtype=float)
+        if np.any(np.diff(self._x_full) < 0):
+            raise ValueError('x must be sorted for decimation')
+        self._view = None
+        lines.Line2D.__init__(self, self._x_full[:0], self._y_full[:0], **kwargs)
+
+    def _update_view(self):
+        ax = self.axes
+        # Align the buckets with the pixel columns of the axes
+        left, right = np.floor(ax.bbox.x0), np.ceil(ax.bbox.x1)
+        n = max(int(right - left), 1)
+        xmin, xmax = ax.transData.inverted().transform([(left, 0), (right, 0)])[:, 0]
+        xmin, xmax = sorted([xmin, xmax])
+        if self._view != (xmin, xmax, n):
+            self._view = (xmin, xmax, n)
+            self.set_data(*decimate(self._x_full, self._y_full, xmin, xmax, n))
+
+    def get_xydata(self):
+        """
+        Full data of the line, whatever the view it was last reduced for
+        """
+        return np.column_stack([self._x_full, self._y_full])
+
+    @mpl.artist.allow_rasterization
+    def draw(self, renderer):
+        if self.axes is not None:
+            self._update_view()
+        lines.Line2D.draw(self, renderer)
+
+def decimated_plot(data, ax, x=None, y=None, color=None, **kwargs):
+    """
+    Line plot of dataframe columns with min/max decimation
+
+    Input
+    -----
+      data : pandas dataframe, sorted by `x`
+      ax : matplotlib axes
+      x : column used as x coordinate (default: index)
+      y : columns to plot (default: all other columns)
+      color : color or list of colors, one per column
+      kwargs : arguments to matplotlib.lines.Line2D
+
+    Output
+    -----
+      list of `DecimatedLine`
+    """
+    xs = data.index.values if x is None else data[x].values
+    if y is None:
+        y = [c for c in data.columns if c != x]
+    elif not isinstance(y, (list, tuple, np.ndarray, pd.Index)):
+        y = [y]
+    if color is None:
+        cycle = mpl.rcParams['axes.prop_cycle'].by_key()['color']
+        color = [cycle[ii % len(cycle)] for ii in range(len(y))]
+    elif mpl.colors.is_color_like(color) or len(color) != len(y):
+        color = [color] * len(y)
+
+    lns = []
+    for col, c in zip(y, color):
+        values = data[col].values
+        line = DecimatedLine(xs, values, color=c, label=col, **kwargs)
+        ax.add_line(line)
+        lns.append(line)
+
+    # Data limits from the full data
+    ys = np.asarray(data[list(y)].values, dtype=float)
+    if len(xs) and np.isfinite(ys).any():
+        ax.update_datalim([(np.nanmin(xs), np.nanmin(ys)), (np.nanmax(xs), np.nanmax(ys))])
+    ax.autoscale_view()
+    if x is not None:
+        ax.set_xlabel(x)
+    return lns
+
+@panels.cached
+def gw_frequency(data, ax=None, decimate=True, **kwargs):
+    """
+    Genome-wide allele frequency of one or more time points
+
+    With `decimate` set (default), each line is reduced to the min/max of
+    every pixel column before drawing (see `DecimatedLine`).
     """
     # Line plots
-    data.plot(
-        ax=ax, kind='line',
-        legend=False, rasterized=True, zorder=2, **kwargs
-    )
+    if decimate:
+        decimated_plot(
+            data, ax,
+            rasterized=True, zorder=2, **kwargs
+        )
+    else:
+        data.plot(
+            ax=ax, kind='line',
+            legend=False, rasterized=True, zorder=2, **kwargs
+        )
     # Draw chromosome shades
-    chr_coords = utils.chr_coords()
-    for chrom, g in chr_coords.groupby('chr_arabic'):
-        ax.axvspan(g.chr_start.squeeze(), g.chr_end.squeeze(),
-                   color=('0.95' if chrom % 2 == 1 else 'w'), lw=0, zorder=0, rasterized=True) 
+    genome_backdrop().shade(ax)
     # Axes limits
     ax.set_ylim(0, 1)
     # Axis tick properties
@@ -235,6 +457,7 @@ def gw_frequency(data, ax=None, **kwargs):
         tick.tick1On = False
         tick.tick2On = False
 
+@panels.cached
 def chr_frequency(data, ax=None, **kwargs):
     """
     
@@ -261,11 +484,13 @@ def chr_frequency(data, ax=None, **kwargs):
         tick.tick1On = False
         tick.tick2On = False
     
+@panels.cached
 def histogram_frequency(data, ax=None, **kwargs):
     """
     
     """
-    # Histogram plots
+    # Histogram plots (data may also be a dict of time -> utils.Histogram,
+    # accumulated chunk by chunk)
     for time in data:
         x, y = histogram_binned_data(ax, data[time], bins=50)
         ax.plot(x, y, color=config.time['color'][time], lw=0.5, rasterized=True, zorder=1)
@@ -355,18 +580,37 @@ def consensus_genotype(data, ax=None):
                 ax, '', '', '', [], [], cmap=cmap, vmin=0, vmax=2)
 
 ### SNV/indel mutations ###
+def genotype_colors(values, colors=config.genotype['color']):
+    """
+    RGBA colors of an array of genotype codes, looked up in one step
+    """
+    codes = np.asarray(values).astype(int)
+    keys = np.array(sorted(colors))
+    lut = mpl.colors.to_rgba_array([colors[k] for k in keys])
+    idx = np.searchsorted(keys, codes).clip(0, len(keys)-1)
+    unknown = keys[idx] != codes
+    if unknown.any():
+        raise KeyError(codes[unknown][0])
+    return lut[idx]
+
 def snv_indel_genotype(data, ax=None):
     """
     Plot genotype of SNVs/indels
+
+    All markers are drawn as a single collection, one row per clone.
     """
     if len(data) > 0:
-        
-        for ii,(k,g) in enumerate(data.groupby(level='clone')):
-            g = g.dropna(axis=1)
-            x = g.columns.get_level_values('pos_cum').values
-            y = [ii+.5]*len(x)
-            colors = [config.genotype['color'][int(gt)] for gt in g.values.flatten()]
-            ax.scatter(x, y, facecolors=colors, edgecolors='k', s=8, rasterized=False, zorder=3)
+
+        # Row of each clone, in sorted order
+        clones = data.index.get_level_values('clone')
+        row, _ = pd.factorize(clones, sort=True)
+        values = data.values.astype(float)
+        ii, jj = np.nonzero(~np.isnan(values))
+
+        x = data.columns.get_level_values('pos_cum').values[jj]
+        y = row[ii] + .5
+        colors = genotype_colors(values[ii, jj])
+        return ax.scatter(x, y, facecolors=colors, edgecolors='k', s=8, rasterized=False, zorder=3)
 
 ### Copy number ###
 def copy_number(data, ax=None):
@@ -406,21 +650,141 @@ def loh_genotype(data, ax=None):
         heatmap(np.r_[x, x.max()+1], np.r_[y, y.max()+1], data,
                 ax, '', '', '', [], [], cmap=cmap, vmin=-1, vmax=1, zorder=1)
 
-def annotate_genotype(data, ax=None):
+class AnnotationLayer(mpl.artist.Artist):
+    """
+    Labels with a wedge pointing at each annotated position, drawn as a
+    single artist
+
+    All wedges are drawn in one marker call, and the labels reuse a single
+    text object instead of creating one annotation per position. With
+    `cull`, labels that would overlap a label already placed at the
+    current resolution are skipped (bold labels are placed first); the
+    wedges are always drawn.
+
+    Input
+    -----
+      x, y : positions in data coordinates
+      labels : label of each position
+      offset : distance between the position and the label (points)
+      fontsize : font size of the labels
+      styles, weights : font style and weight of each label
+      cull : skip overlapping labels
+      color, tail_width, shrink : wedge color, width (fraction of the font
+          size) and gap to the label and to the position (points)
+    """
+    def __init__(self, x, y, labels, offset=4, fontsize=5, styles=None, weights=None,
+                 cull=False, color='black', tail_width=0.7, shrink=2, **kwargs):
+        mpl.artist.Artist.__init__(self)
+        self.xy = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        self.labels = [u'%s' % l for l in labels]
+        n = len(self.labels)
+        self.styles = ['normal']*n if styles is None else list(styles)
+        self.weights = ['normal']*n if weights is None else list(weights)
+        self.offset = offset
+        self.fontsize = fontsize
+        self.cull = cull
+        self.color = color
+        self.tail_width = tail_width
+        self.shrink = shrink
+        self.text = mpl.text.Text(0, 0, '', fontsize=fontsize, color=color,
+                                  va='bottom', ha='center', **kwargs)
+        self.text.set_transform(mpl.transforms.IdentityTransform())
+        self.set_zorder(3)
+        self.set_clip_on(False)
+
+    def _anchors(self):
+        return self.axes.transData.transform(self.xy)
+
+    def _set_label(self, ii, xy):
+        self.text.set_text(self.labels[ii])
+        self.text.set_fontstyle(self.styles[ii])
+        self.text.set_fontweight(self.weights[ii])
+        self.text.set_position(xy)
+
+    def layout(self, renderer):
+        """
+        Indices, positions and extents of the labels placed at the current
+        resolution
+        """
+        self.text.set_figure(self.figure)
+        pos = self._anchors()
+        pos[:, 1] += renderer.points_to_pixels(self.offset)
+        placed, xy, boxes = [], [], []
+        starts, stops = [], []
+        bold = [w == 'bold' for w in self.weights]
+        order = sorted(range(len(self.labels)), key=lambda ii: (not bold[ii], pos[ii, 0]))
+        for ii in order:
+            self._set_label(ii, pos[ii])
+            bbox = self.text.get_window_extent(renderer)
+            if self.cull:
+                # Labels share a baseline, so only the x-extents can collide
+                k = bisect.bisect(starts, bbox.x0)
+                if (k > 0 and stops[k-1] > bbox.x0) or (k < len(starts) and starts[k] < bbox.x1):
+                    continue
+                starts.insert(k, bbox.x0)
+                stops.insert(k, bbox.x1)
+            placed.append(ii)
+            xy.append(pos[ii])
+            boxes.append(bbox)
+        return placed, xy, boxes
+
+    def get_window_extent(self, renderer=None):
+        if renderer is None:
+            renderer = self.figure.canvas.get_renderer()
+        _, _, boxes = self.layout(renderer)
+        if not boxes:
+            return mpl.transforms.Bbox.null()
+        return mpl.transforms.Bbox.union(boxes)
+
+    def draw(self, renderer):
+        if not self.get_visible() or len(self.labels) == 0:
+            return
+        renderer.open_group('annotation_layer', gid=self.get_gid())
+
+        # Wedges, from the label down to the position, shrunk at both
+        # ends as in `annotate`
+        tip = renderer.points_to_pixels(self.shrink)
+        tail = max(renderer.points_to_pixels(self.offset - self.shrink), tip)
+        width = renderer.points_to_pixels(self.tail_width * self.fontsize)
+        wedge = mpl.path.Path([(-width/2., tail), (width/2., tail), (0, tip), (-width/2., tail)],
+                              closed=True)
+        gc = renderer.new_gc()
+        gc.set_foreground(self.color)
+        gc.set_linewidth(1)
+        rgb = mpl.colors.to_rgba(self.color)
+        renderer.draw_markers(gc, wedge, mpl.transforms.IdentityTransform(),
+                              mpl.path.Path(self._anchors()), mpl.transforms.IdentityTransform(), rgb)
+        gc.restore()
+
+        # Labels
+        placed, xy, _ = self.layout(renderer)
+        for ii, pos in zip(placed, xy):
+            self._set_label(ii, pos)
+            self.text.draw(renderer)
+
+        renderer.close_group('annotation_layer')
+        self.stale = False
+
+def annotate_genotype(data, ax=None, cull=False):
     """
     Annotate mutation genotype
+
+    All labels and wedges are drawn by a single `AnnotationLayer`. With
+    `cull`, overlapping labels are skipped at the current resolution.
     """
     labels = data.columns.get_level_values('gene')
-    loc = zip(data.columns.get_level_values('pos_cum'), [-.25]*data.shape[1])
-        
-    for l, xy in zip(labels, loc):
-        trans = ax.get_xaxis_transform() # x in data units, y in axes fraction
-        ax.annotate(l, xy=xy, xytext=(0, 4), textcoords='offset points',
-                    arrowprops=dict(arrowstyle='wedge,tail_width=0.7', color='black'),
-                    fontsize=5, style=('italic' if l!='non-coding' else 'normal'),
-                    weight=('bold' if l in ['RNR2','RNR4','FPR1','TOR1'] else 'normal'),
-                    annotation_clip=False, va='bottom', ha='center')
+    x = data.columns.get_level_values('pos_cum').values
 
+    layer = AnnotationLayer(
+        x, [-.25]*data.shape[1], labels, offset=4, fontsize=5,
+        styles=[('italic' if l!='non-coding' else 'normal') for l in labels],
+        weights=[('bold' if l in ['RNR2','RNR4','FPR1','TOR1'] else 'normal') for l in labels],
+        cull=cull
+    )
+    ax.add_artist(layer)
+    return layer
+
+@panels.cached
 def genome_instability(data, ax=None, title=None):
     """
     
@@ -437,7 +801,7 @@ def genome_instability(data, ax=None, title=None):
         ax1 = plt.subplot(ax[idx:idx+nrows])
         consensus_genotype(consensus_data, ax1)
         
-        if ax1.is_first_row():
+        if ax1.get_subplotspec().is_first_row():
             # Set axis label
             labels = ['Consensus']
             ax1.set_yticks(np.arange(len(labels)) + 0.5, minor=True)
@@ -496,20 +860,16 @@ def scatter_plot(x, y, ax=None, **kwargs):
     ax.get_xaxis().tick_bottom()
     ax.get_yaxis().tick_left()
 
+@panels.cached
 def histogram_x(X, ax=None, time=None):
     """
     
     """
     import gmm
                 
-    # Fit the Gaussian mixture model
+    # Fit the Gaussian mixture model (cached) and select it by BIC
     N = np.arange(1, 4)
-    models = gmm.gmm_fit(X, N)
-
-    # Compute the AIC and the BIC
-    AIC = [m.aic(X) for m in models]
-    BIC = [m.bic(X) for m in models]
-    M_best = models[np.argmin(BIC)]
+    M_best = gmm.gmm_best(X, N)
     
     # Plot data
     bins = 34
@@ -521,8 +881,10 @@ def histogram_x(X, ax=None, time=None):
     xbins = np.linspace(ax.get_xlim()[0], ax.get_xlim()[1], 1000)
     logprob = M_best.score_samples(np.array([xbins]).T)
     pdf = np.exp(logprob)
+    # Fraction of observations per bin, as in the histogram
+    width = (np.nanmax(X) - np.nanmin(X)) / float(bins)
             
-    ax.plot(xbins, pdf / bins, '-', 
+    ax.plot(xbins, pdf * width, '-', 
             color=config.population['color'][time], lw=1)
 
     # Mean of the distribution
@@ -549,20 +911,16 @@ def histogram_x(X, ax=None, time=None):
     ax.get_xaxis().tick_bottom()
     ax.get_yaxis().tick_left()
 
+@panels.cached
 def histogram_y(Y, ax=None, time=None):
     """
     
     """
     import gmm
                 
-    # Fit the Gaussian mixture model
+    # Fit the Gaussian mixture model (cached) and select it by BIC
     N = np.arange(1, 4)
-    models = gmm.gmm_fit(Y, N)
-
-    # Compute the AIC and the BIC
-    AIC = [m.aic(Y) for m in models]
-    BIC = [m.bic(Y) for m in models]
-    M_best = models[np.argmin(BIC)]
+    M_best = gmm.gmm_best(Y, N)
             
     # Plot data
     bins = 34
@@ -574,8 +932,10 @@ def histogram_y(Y, ax=None, time=None):
     ybins = np.linspace(ax.get_ylim()[0], ax.get_ylim()[1], 1000)
     logprob = M_best.score_samples(np.array([ybins]).T)
     pdf = np.exp(logprob)
+    # Fraction of observations per bin, as in the histogram
+    width = (np.nanmax(Y) - np.nanmin(Y)) / float(bins)
             
-    ax.plot(pdf / bins, ybins, '-', 
+    ax.plot(pdf * width, ybins, '-', 
             color=config.population['color'][time], lw=1)
 
     # Mean of the distribution
@@ -665,20 +1025,84 @@ def scatter_rank_correlation(data, ax=None, environment=None):
     ax.spines['left'].set_visible(False)
 
 
+class GenomeBackdrop(object):
+    """
+    Chromosome shading and boundaries of a reference genome
+
+    The paths are built once and shared by the collections added to each
+    axes, so that a figure with many genome-wide panels does not rebuild
+    the chromosome coordinates nor add one artist per chromosome and panel.
+    Shading and boundaries span the full height of the axes.
+
+    Input
+    -----
+      genome : `utils.GenomeCoordinates` (default: the reference genome)
+    """
+    def __init__(self, genome=None):
+        if genome is None:
+            genome = utils.genome_coordinates()
+        self.genome = genome
+        starts = genome.starts.astype(float)
+        ends = genome.ends.astype(float)
+        self.extent = (starts.min(), ends.max())
+        self.shade_paths = [mpl.path.Path([(s, 0), (s, 1), (e, 1), (e, 0), (s, 0)], closed=True)
+                            for s, e in zip(starts, ends)]
+        self.shade_colors = [('0.95' if chrom % 2 == 1 else 'w') for chrom in genome.chroms]
+        self.boundary_paths = [mpl.path.Path([(x, 0), (x, 1)]) for x in np.unique(starts) + 1.]
+        self.ticks = starts + (ends - starts)/2.
+        self.labels = [utils.int_to_roman(chrom) for chrom in genome.chroms]
+
+    def _add(self, ax, collection):
+        collection.set_transform(ax.get_xaxis_transform()) # x in data units, y in axes fraction
+        ax.add_collection(collection, autolim=False)
+        ax.update_datalim([(self.extent[0], 0), (self.extent[1], 0)], updatey=False)
+        ax.autoscale_view(scaley=False)
+        return collection
+
+    def shade(self, ax, **kwargs):
+        """
+        Shade alternate chromosomes, as a single collection
+        """
+        kwargs = utils.merge_two_dicts(dict(facecolors=self.shade_colors, edgecolors='none',
+                                            linewidths=0, zorder=0, rasterized=True), kwargs)
+        return self._add(ax, mpl.collections.PathCollection(self.shade_paths, **kwargs))
+
+    def boundaries(self, ax, **kwargs):
+        """
+        Vertical lines at the chromosome boundaries, as a single collection
+        """
+        kwargs = utils.merge_two_dicts(dict(facecolors='none', edgecolors='gray',
+                                            linewidths=0.5, linestyles='-', zorder=2), kwargs)
+        return self._add(ax, mpl.collections.PathCollection(self.boundary_paths, **kwargs))
+
+    def set_ticks(self, ax):
+        """
+        Label the chromosomes at their midpoints
+        """
+        ax.set_xticks(self.ticks)
+        ax.set_xticklabels(self.labels)
+
+# Backdrops of each reference genome, built once
+_BACKDROPS = {}
+
+def genome_backdrop(chrom_len=None):
+    """
+    Shared `GenomeBackdrop` of a reference genome (default: config.chrom_len)
+    """
+    genome = utils.genome_coordinates(chrom_len)
+    if genome not in _BACKDROPS:
+        _BACKDROPS[genome] = GenomeBackdrop(genome)
+    return _BACKDROPS[genome]
+
 def chrom_boundaries(ax=None):
     """
     Show chromosome boundaries
     """
+    backdrop = genome_backdrop()
     # Set labels
-    chr_coords = utils.chr_coords()
-    ticks = chr_coords.chr_start + (chr_coords.chr_end - chr_coords.chr_start)/2.
-    labels = chr_coords.chr_roman
-    ax.set_xticks(ticks)
-    ax.set_xticklabels(labels)
+    backdrop.set_ticks(ax)
     # Show grid
-    start = chr_coords.chr_start
-    grid=[x+1. for x in list(set(start))]
-    [ax.axvline(g, lw=0.5, ls="-", color="gray") for g in grid]
+    backdrop.boundaries(ax)
 
 def set_custom_labels(index, pos):
     """
@@ -767,27 +1191,63 @@ def zoom_effect(ax1, ax2, xmin, xmax, **kwargs):
 
     return c1, c2, bbox_patch1, bbox_patch2, p
 
+def place_labels(x_data, y_data, txt_width, txt_height):
+    """
+    Move overlapping labels up, one label at a time
+
+    Each label is compared with the labels within two text widths along
+    x that are not below it by more than a text height (using the
+    positions adjusted so far). If the nearest of them collides, the label
+    is moved to the first gap of at least two text heights between them,
+    or above the highest one. Neighbours are found in a window of the
+    labels sorted by x, so the cost grows with the number of nearby labels
+    rather than with the square of the total.
+
+    Input
+    -----
+      x_data, y_data : label positions
+      txt_width, txt_height : size of a label, in data units
+
+    Output
+    -----
+      adjusted y positions (as a numpy array) and number of displaced labels
+    """
+    xs = np.asarray(x_data, dtype=float)
+    ys = np.array(y_data, dtype=float)
+    order = np.argsort(xs, kind='mergesort')
+    xs_sorted = xs[order]
+    reach = txt_width * 2
+
+    for index in range(len(xs)):
+        x, y = xs[index], ys[index]
+        # Labels within reach along x (window widened to apply the strict
+        # test below on the exact differences)
+        lo = np.searchsorted(xs_sorted, x - reach, side='left')
+        hi = np.searchsorted(xs_sorted, x + reach, side='right')
+        window = order[lo:hi]
+        near = (np.abs(xs[window] - x) < reach) & (ys[window] > (y - txt_height))
+        near &= ~((ys[window] == y) & (xs[window] == x))
+        if not near.any():
+            continue
+        local = np.sort(ys[window[near]])
+        if abs(local[0] - y) < txt_height: # collision
+            ys[index] = local[-1] + txt_height
+            # Room to fit the label between two neighbours
+            gaps = np.flatnonzero(np.diff(local) > txt_height * 2)
+            if len(gaps):
+                ys[index] = local[gaps[0]] + txt_height
+
+    displaced = int(np.sum(ys != np.asarray(y_data, dtype=float)))
+    return ys, displaced
+
 def get_text_positions(x_data, y_data, txt_width, txt_height):
     """
-    
+    Adjusted y positions of labels so that they do not overlap (see
+    `place_labels`)
     """
-    a = zip(y_data, x_data)
+    ys, _ = place_labels(x_data, y_data, txt_width, txt_height)
     text_positions = y_data.copy()
-    for index, (y, x) in enumerate(a):
-        local_text_positions = [i for i in a if i[0] > (y - txt_height) 
-                            and (abs(i[1] - x) < txt_width * 2) and i != (y,x)]
-        if local_text_positions:
-            sorted_ltp = sorted(local_text_positions)
-            if abs(sorted_ltp[0][0] - y) < txt_height: #True == collision
-                differ = np.diff(sorted_ltp, axis=0)
-                a[index] = (sorted_ltp[-1][0] + txt_height, a[index][1])
-                text_positions[index] = sorted_ltp[-1][0] + txt_height
-                for k, (j, m) in enumerate(differ):
-                    #j is the vertical distance between words
-                    if j > txt_height * 2: #if True then room to fit a word in
-                        a[index] = (sorted_ltp[k][0] + txt_height, a[index][1])
-                        text_positions[index] = sorted_ltp[k][0] + txt_height
-                        break
+    text_positions[:] = ys
     return text_positions
 
 def text_plotter(x_data, y_data, text_positions, axis,txt_width,txt_height):
@@ -856,15 +1316,62 @@ def colormap_discretize(cmap, N):
     # Return colormap object
     return mcolors.LinearSegmentedColormap(cmap.name + "_%d"%N, cdict, 1024)
 
-def save_figure(filename, formats=['pdf','png','svg'], **kwargs):
+def _save_format(args):
+    """
+    Write a pickled figure in one format
+    """
+    data, filename, fmt, bbox, kwargs = args
+    fig = pickle.loads(data)
+    start = time.time()
+    fig.savefig(filename+'.'+fmt, bbox_inches=bbox, **kwargs)
+    return fmt, time.time() - start
+
+def save_figure(filename, formats=['pdf','png','svg'], fig=None, parallel=False, **kwargs):
     """
     Save matplotlib figure in multiple formats (pdf, png, svg).
         formats: list of formats.
+        fig: figure to save (default: current figure).
+        parallel: write the formats concurrently in worker processes. Each
+            worker unpickles and redraws the whole figure, which is usually
+            slower than writing the formats in turn.
         kwargs: arguments to plt.savefig (e.g. dpi).
-    """
-    if 'pdf' in formats:
-        plt.savefig(filename+'.pdf', bbox_inches='tight', **kwargs)
-    if 'png' in formats:
-        plt.savefig(filename+'.png', bbox_inches='tight', **kwargs)
-    if 'svg' in formats:
-        plt.savefig(filename+'.svg', bbox_inches='tight', **kwargs)
+    The tight bounding box is computed from a single layout pass and
+    shared by all formats, instead of each savefig call laying out the
+    figure again. Returns the time spent per format (and on layout), in
+    seconds.
+    """
+    if fig is None:
+        fig = plt.gcf()
+    timing = {}
+
+    # Lay out the figure once to get the tight bounding box
+    start = time.time()
+    fig.canvas.draw()
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    bbox = bbox.padded(kwargs.pop('pad_inches', mpl.rcParams['savefig.pad_inches']))
+    timing['layout'] = time.time() - start
+
+    formats = [fmt for fmt in ['pdf','png','svg'] if fmt in formats]
+    data = None
+    if parallel and len(formats) > 1:
+        try:
+            data = pickle.dumps(fig, protocol=-1)
+        except Exception:
+            # Some artists cannot be pickled; fall back to sequential writes
+            data = None
+
+    if data is not None:
+        pool = Pool(len(formats))
+        try:
+            jobs = [(data, filename, fmt, bbox, kwargs) for fmt in formats]
+            timing.update(pool.map(_save_format, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for fmt in formats:
+            start = time.time()
+            fig.savefig(filename+'.'+fmt, bbox_inches=bbox, **kwargs)
+            timing[fmt] = time.time() - start
+
+    return timing
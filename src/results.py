@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Input-hashed store of filterHD/cloneHD results
+"""
+
+# Load external dependencies
+from setup import *
+import os, json, glob, time, shutil, hashlib
+# Load internal dependencies
+import cache
+
+# Directory holding the stored results, one subdirectory per key
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'subclonality')
+
+# Size cap of the store; least recently used results are evicted
+MAX_BYTES = 2 * 2**30
+
+VERSION = 1
+
+def _meta_path(path):
+    return os.path.join(path, 'meta.json')
+
+def _digests_path(cache_dir):
+    return os.path.join(cache_dir, 'digests.json')
+
+def file_digest(fn, digests=None):
+    """
+    SHA-1 of the contents of a file
+
+    Input
+    -----
+      fn : filename
+      digests : optional dict of digests computed earlier, keyed by
+          path and checked against the size and modification time of
+          the file (see `cache.source_stamp`); updated in place
+    """
+    stamp = cache.source_stamp(fn, {})
+    path = stamp['path']
+    if digests is not None and path in digests and digests[path]['stamp'] == stamp:
+        return digests[path]['digest']
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    if digests is not None:
+        digests[path] = {'stamp': stamp, 'digest': digest}
+    return digest
+
+def read_digests(cache_dir=CACHE_DIR):
+    fn = _digests_path(cache_dir)
+    if not os.path.exists(fn):
+        return {}
+    try:
+        with open(fn, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def write_digests(digests, cache_dir=CACHE_DIR):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    fn = _digests_path(cache_dir)
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(digests, f)
+    os.rename(fn + '.tmp', fn)
+
+def job_key(command, inputs, pre, deps=(), digests=None):
+    """
+    Hash of a filterHD/cloneHD command, of the contents of its input
+    files and of the keys of the jobs whose output it reads
+
+    Input files are identified by their contents and output paths by
+    their location relative to the output directory, so that a result
+    is found again whatever the location of the data. The binary is
+    identified by its contents if it is a file, by its name otherwise.
+
+    Input
+    -----
+      command : list of arguments, starting with the binary
+      inputs : input files appearing in `command`
+      pre : output prefix of the job
+      deps : keys of the jobs it depends on
+      digests : optional dict of file digests (see `file_digest`)
+    """
+    inputs = set(os.path.abspath(fn) for fn in inputs)
+    results = os.path.dirname(os.path.abspath(pre)) + os.sep
+    binary = command[0]
+    args = [file_digest(binary, digests) if os.path.isfile(binary) else os.path.basename(binary)]
+    for arg in command[1:]:
+        path = os.path.abspath(arg)
+        if path in inputs:
+            arg = file_digest(path, digests)
+        elif path.startswith(results):
+            arg = os.path.relpath(path, results)
+        args.append(arg)
+    h = hashlib.sha1()
+    h.update(json.dumps([VERSION, args, list(deps)]).encode('utf-8'))
+    return h.hexdigest()
+
+def snapshot(pre):
+    """
+    Modification time and size of the files starting with an output prefix
+    """
+    files = {}
+    for fn in glob.glob(pre + '.*'):
+        try:
+            st = os.stat(fn)
+        except OSError:
+            continue
+        files[os.path.abspath(fn)] = (st.st_mtime, st.st_size)
+    return files
+
+def outputs(pre, before, exclude=()):
+    """
+    Files written by a job: those starting with its output prefix that
+    are new or changed since the `snapshot` taken before it started,
+    other than its input files
+    """
+    exclude = set(os.path.abspath(fn) for fn in exclude)
+    after = snapshot(pre)
+    return sorted(fn for fn, st in after.items()
+                  if fn not in exclude and os.path.isfile(fn) and before.get(fn) != st)
+
+def load(key, pre, cache_dir=CACHE_DIR):
+    """
+    Copy the stored output files of a job to its output prefix
+
+    Output
+    -----
+      list of restored filenames, or None if the key is not stored
+    """
+    path = os.path.join(cache_dir, key)
+    try:
+        with open(_meta_path(path), 'r') as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('version') != VERSION:
+        return None
+    files = []
+    for suffix in meta['files']:
+        fn = pre + suffix
+        shutil.copyfile(os.path.join(path, suffix.lstrip('.')), fn)
+        files.append(fn)
+    os.utime(_meta_path(path), None) # mark as recently used
+    return files
+
+def store(key, pre, files, command=None, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    Copy the output files of a job to the store and evict the least
+    recently used results above `max_bytes`
+
+    Input
+    -----
+      key : key of the job (see `job_key`)
+      pre : output prefix of the job
+      files : output files, all starting with `pre`
+      command : optional command, kept for reference
+    """
+    path = os.path.join(cache_dir, key)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    suffixes = []
+    for fn in files:
+        suffix = fn[len(pre):]
+        shutil.copyfile(fn, os.path.join(tmp, suffix.lstrip('.')))
+        suffixes.append(suffix)
+    meta = {
+        'version': VERSION,
+        'files': suffixes,
+        'command': command,
+        'created': time.time()
+    }
+    with open(_meta_path(tmp), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    evict(cache_dir, max_bytes)
+
+def _size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, fn))
+            except OSError:
+                pass
+    return total
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    Delete the least recently used results until the store fits in `max_bytes`
+    """
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*')):
+        try:
+            mtime = os.stat(_meta_path(path)).st_mtime
+        except OSError:
+            continue
+        entries.append((mtime, _size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def clear(cache_dir=CACHE_DIR):
+    """
+    Delete all stored results
+    """
+    evict(cache_dir, 0)
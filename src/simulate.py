@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Simulation of subclonal mixtures in the filterHD/cloneHD file formats
+"""
+
+# Load external dependencies
+from setup import *
+import os, sys
+from multiprocessing import Pool
+from scipy.optimize import linear_sum_assignment
+# Load internal dependencies
+import tracks
+
+# Number of significant digits of simulated frequencies
+DIGITS = 10
+
+def _random_state(random_state):
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+def _logistic(x):
+    return 1. / (1. + np.exp(-x))
+
+def simulate_loci(n_loci, n_chroms=1, spacing=105, random_state=None):
+    """
+    Loci spread evenly over `n_chroms` chromosomes, `spacing` bp apart on
+    average, starting at position 1 of each chromosome
+
+    Output
+    -----
+      tuple of arrays (chromosome, locus)
+    """
+    rs = _random_state(random_state)
+    chrom = np.repeat(np.arange(1, n_chroms + 1), np.diff(np.linspace(0, n_loci, n_chroms + 1).astype(int)))
+    step = rs.poisson(spacing - 1, size=n_loci) + 1
+    first = np.r_[True, chrom[1:] != chrom[:-1]]
+    step[first] = 0
+    # Cumulative sum restarting at each chromosome
+    pos = np.cumsum(step)
+    pos = pos - np.maximum.accumulate(np.where(first, pos, 0)) + 1
+    return chrom, pos
+
+def _segment_ids(chrom, n_breaks, rs):
+    """
+    Segment index of each locus, with `n_breaks` random breakpoints in
+    addition to the chromosome boundaries
+    """
+    n = len(chrom)
+    starts = np.flatnonzero(np.r_[True, chrom[1:] != chrom[:-1]])
+    breaks = np.union1d(starts, rs.randint(1, max(n, 2), size=n_breaks))
+    return np.searchsorted(breaks, np.arange(n), side='right') - 1, len(breaks)
+
+def _events(chrom, n_events, n_clones, length, rs):
+    """
+    Indicator of `n_events` events per locus and clone, each covering on
+    average `length` consecutive loci of one clone within one chromosome
+    """
+    n = len(chrom)
+    counts = np.zeros((n + 1, n_clones), dtype=np.int32)
+    if n_events > 0:
+        start = rs.randint(0, n, size=n_events)
+        stop = start + rs.geometric(1. / max(length, 1), size=n_events)
+        # Events end at the end of their chromosome
+        ends = np.r_[np.flatnonzero(chrom[1:] != chrom[:-1]) + 1, n]
+        stop = np.minimum(stop, ends[np.searchsorted(ends, start, side='right')])
+        clone = rs.randint(0, n_clones, size=n_events)
+        np.add.at(counts, (start, clone), 1)
+        np.add.at(counts, (stop, clone), -1)
+    return np.cumsum(counts, axis=0)[:n] > 0
+
+def simulate_fractions(n_clones, n_samples, random_state=None):
+    """
+    Cell fractions of each subclone in each sample (time point), growing
+    logistically towards a random share of at most 95% of the cells
+
+    Output
+    -----
+      array of shape (n_samples, n_clones)
+    """
+    rs = _random_state(random_state)
+    t = np.linspace(0, 1, n_samples)[:, None]
+    onset = np.sort(rs.uniform(-0.5, 0.8, size=n_clones))
+    rate = rs.uniform(5, 15, size=n_clones)
+    size = rs.dirichlet(np.ones(n_clones)) * rs.uniform(0.5, 0.95)
+    f = size * _logistic(rate * (t - onset))
+    return f / np.maximum(1., f.sum(axis=1, keepdims=True))
+
+def simulate(n_loci=10000, n_clones=2, n_samples=3, n_chroms=1, depth=30, spacing=105,
+             snv_jumps=30, cna_events=0, loh_events=0, event_length=500, max_tcn=4,
+             bulk_sigma=0.05, fractions=None, random_state=None):
+    """
+    Simulate a bulk sample and a time series of mixtures of subclones
+
+    Each subclone has a total copy number and a number of mutated copies
+    at each locus, constant between jumps. Copy-number events add or
+    remove one copy; LOH events make a region homozygous (copy-neutral).
+    The normal cells carry the bulk allele frequency, a random walk on
+    the logit scale. Read depths are Poisson with mean `depth` per copy
+    and read counts binomial, as in the example of
+    data/seq/subclonality/simulation.
+
+    Input
+    -----
+      n_loci : number of loci
+      n_clones : number of subclones
+      n_samples : number of mixture samples (time points)
+      n_chroms : number of chromosomes
+      depth : mean number of reads per copy (the mass)
+      spacing : mean distance between loci in bp
+      snv_jumps : number of changes of the SNV genotype of the subclones
+      cna_events, loh_events : number of copy-number and LOH events
+      event_length : mean length of an event in loci
+      max_tcn : maximum total copy number
+      bulk_sigma : step size of the bulk allele frequency random walk
+      fractions : cell fractions of shape (n_samples, n_clones)
+          (default: see `simulate_fractions`)
+
+    Output
+    -----
+      dict of arrays, as written by `write`
+    """
+    rs = _random_state(random_state)
+    chrom, locus = simulate_loci(n_loci, n_chroms, spacing, rs)
+    if fractions is None:
+        fractions = simulate_fractions(n_clones, n_samples, rs)
+    fractions = np.asarray(fractions, dtype=float)
+    n_samples, n_clones = fractions.shape
+
+    # Copy number and LOH of each subclone
+    n_gains = rs.binomial(cna_events, 0.5)
+    gain = _events(chrom, n_gains, n_clones, event_length, rs)
+    loss = _events(chrom, cna_events - n_gains, n_clones, event_length, rs)
+    tcn = np.clip(2 + gain.astype(int) - loss.astype(int), 1, max_tcn)
+    loh = _events(chrom, loh_events, n_clones, event_length, rs)
+    minor = np.where(loh | (tcn < 2), 0, 1)
+    major = tcn - minor
+
+    # Mutated copies of each subclone, constant between SNV jumps and
+    # homozygous within LOH regions
+    seg, n_seg = _segment_ids(chrom, snv_jumps, rs)
+    u = rs.rand(n_seg, n_clones)[seg]
+    snv = np.floor(u * (tcn + 1)).astype(int)
+    snv = np.where(loh, np.where(u < 0.5, 0, tcn), snv)
+
+    # Bulk allele frequency
+    steps = rs.normal(0, bulk_sigma, size=len(chrom))
+    steps[np.r_[True, chrom[1:] != chrom[:-1]]] = rs.normal(0, 1, size=n_chroms)
+    bulk = _logistic(np.cumsum(steps) - 0.5)
+    bias = np.ones(len(chrom))
+
+    # Expected copy number, depth and allele frequency of each mixture
+    normal = 1. - fractions.sum(axis=1)
+    mean_tcn = 2. * normal + tcn.dot(fractions.T)
+    xcna = depth * mean_tcn * bias[:, None]
+    xsnv = (2. * normal * bulk[:, None] + snv.dot(fractions.T)) / mean_tcn
+
+    # Read counts
+    mixture_depth = rs.poisson(xcna)
+    mixture_reads = rs.binomial(mixture_depth, xsnv)
+    bulk_depth = rs.poisson(2. * depth * bias)
+    bulk_reads = rs.binomial(bulk_depth, bulk)
+    bulk_cna_depth = rs.poisson(2. * depth * bias)
+
+    return {
+        'chrom': chrom, 'locus': locus, 'depth': depth, 'fractions': fractions,
+        'tcn': tcn, 'major': major, 'minor': minor, 'snv': snv, 'bulk': bulk, 'bias': bias,
+        'mean_tcn': mean_tcn, 'xcna': xcna, 'xsnv': xsnv,
+        'mixture_depth': mixture_depth, 'mixture_reads': mixture_reads,
+        'bulk_depth': bulk_depth, 'bulk_reads': bulk_reads, 'bulk_cna_depth': bulk_cna_depth
+    }
+
+def _jumps(chrom, values):
+    """
+    Loci where any column of `values` changes within a chromosome
+    """
+    change = np.any(values[1:] != values[:-1], axis=1) & (chrom[1:] == chrom[:-1])
+    return np.flatnonzero(change) + 1
+
+def _interleave(a, b):
+    out = np.empty((a.shape[0], a.shape[1] * 2), dtype=a.dtype)
+    out[:, 0::2], out[:, 1::2] = a, b
+    return out
+
+def _write(f, columns, chunksize=10**5):
+    """
+    Write columns as tab-separated text, one chunk of rows at a time
+    (faster than pandas.to_csv or numpy.savetxt for large tracks)
+    """
+    if not hasattr(f, 'write'):
+        with open(f, 'w') as fh:
+            return _write(fh, columns, chunksize)
+    columns = [np.asarray(c) for c in columns]
+    fmt = '\t'.join('%d' if c.dtype.kind in 'iub' else '%%.%dg' % DIGITS for c in columns) + '\n'
+    n = len(columns[0]) if columns else 0
+    for start in range(0, n, chunksize):
+        rows = zip(*[c[start:start+chunksize].tolist() for c in columns])
+        f.write(''.join([fmt % r for r in rows]))
+
+def write(sim, out_dir):
+    """
+    Write a simulation in the layout of data/seq/subclonality/simulation
+
+    Input files of filterHD/cloneHD: bulk.snv.txt, bulk.cna.txt,
+    mixture.snv.txt and mixture.cna.txt (read counts and depths, one pair
+    of columns per sample), and loci.txt.
+
+    Truth files: clones.txt (mass and cell fractions of each sample),
+    clonal.true.cna.txt (total copy number per subclone),
+    clonal.true.chr.txt (major and minor copy number per subclone),
+    clonal.true.snv.txt (mutated copies per subclone), their jumps
+    (clonal.true.cna.jumps.txt, clonal.true.snv.jumps.txt), and
+    mixture.true.mean-tcn.txt, mixture.true.xcna.txt,
+    mixture.true.xsnv.txt, true.bulk.txt and true.bias.txt.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    path = lambda fn: os.path.join(out_dir, fn)
+    chrom, locus = sim['chrom'], sim['locus']
+    n_samples = sim['fractions'].shape[0]
+    ones = np.ones(len(chrom), dtype=int)
+
+    # Input data
+    _write(path('loci.txt'), [locus])
+    _write(path('bulk.snv.txt'), [chrom, locus, sim['bulk_reads'], sim['bulk_depth']])
+    _write(path('bulk.cna.txt'), [chrom, locus, sim['bulk_cna_depth'], ones])
+    snv, cna = [chrom, locus], [chrom, locus]
+    for s in range(n_samples):
+        snv += [sim['mixture_reads'][:, s], sim['mixture_depth'][:, s]]
+        cna += [sim['mixture_depth'][:, s], ones]
+    _write(path('mixture.snv.txt'), snv)
+    _write(path('mixture.cna.txt'), cna)
+
+    # Truth
+    clones = np.c_[np.full(n_samples, sim['depth']), sim['fractions']]
+    _write(path('clones.txt'), list(clones.T))
+    _write(path('clonal.true.cna.txt'), [chrom, locus] + list(sim['tcn'].T))
+    _write(path('clonal.true.chr.txt'), [chrom, locus] + list(_interleave(sim['major'], sim['minor']).T))
+    _write(path('clonal.true.snv.txt'), [chrom, locus] + list(sim['snv'].T))
+    for name, values in [('cna', sim['tcn']), ('snv', sim['snv'])]:
+        idx = _jumps(chrom, values)
+        with open(path('clonal.true.%s.jumps.txt' % name), 'w') as f:
+            if len(idx):
+                _write(f, [chrom[idx], locus[idx]])
+    for name in ['mean_tcn', 'xcna', 'xsnv']:
+        fn = 'mixture.true.%s.txt' % name.replace('_', '-')
+        _write(path(fn), [chrom, locus] + list(sim[name].T))
+    _write(path('true.bulk.txt'), [chrom, locus, sim['bulk']])
+    _write(path('true.bias.txt'), [chrom, locus, sim['bias']])
+
+def _replicate(args):
+    out_dir, kwargs = args
+    write(simulate(**kwargs), out_dir)
+    return out_dir
+
+def simulate_replicates(n, out_dir, processes=None, random_state=0, **kwargs):
+    """
+    Simulate and write `n` replicate datasets in a process pool
+
+    Replicate i is written to <out_dir>/replicate-<i> with seed
+    `random_state` + i, so that each is reproducible on its own.
+
+    Input
+    -----
+      n : number of replicates
+      out_dir : output directory
+      processes : number of worker processes (default: number of cores)
+      random_state : seed of the first replicate
+      kwargs : arguments to `simulate`
+
+    Output
+    -----
+      list of replicate directories
+    """
+    jobs = []
+    for ii in range(n):
+        job = dict(kwargs, random_state=random_state + ii)
+        jobs.append((os.path.join(out_dir, 'replicate-%03d' % ii), job))
+
+    pool = Pool(processes)
+    try:
+        dirs = list(pool.imap(_replicate, jobs))
+    finally:
+        pool.close()
+        pool.join()
+    return dirs
+
+def score_fractions(truth_dir, summary_fn):
+    """
+    Compare the mass and cell fractions estimated by cloneHD with the
+    simulated ones
+
+    Estimated subclones are matched to simulated ones so as to minimise
+    the total absolute error; missing or extra subclones count as zero
+    fractions.
+
+    Input
+    -----
+      truth_dir : directory of a simulation (see `write`)
+      summary_fn : cloneHD summary file, e.g. mixture.summary.txt
+
+    Output
+    -----
+      dict with the number of simulated and estimated subclones, the mean
+      relative error of the mass and the mean absolute error of the
+      fractions
+    """
+    truth = np.loadtxt(os.path.join(truth_dir, 'clones.txt'), ndmin=2)
+    _, table = tracks.read_summary(summary_fn)
+    table = table[:, ~np.all(np.isnan(table), axis=0)] if table.size else table
+    if table.shape[0] != truth.shape[0]:
+        raise ValueError('%d samples in %s, %d in the simulation' %
+                         (table.shape[0], summary_fn, truth.shape[0]))
+    f_true, f_est = truth[:, 1:], np.nan_to_num(table[:, 1:])
+    k = max(f_true.shape[1], f_est.shape[1])
+    f_true = np.pad(f_true, ((0, 0), (0, k - f_true.shape[1])), 'constant')
+    f_est = np.pad(f_est, ((0, 0), (0, k - f_est.shape[1])), 'constant')
+    cost = np.abs(f_true[:, :, None] - f_est[:, None, :]).sum(axis=0)
+    row, col = linear_sum_assignment(cost)
+    return {
+        'clones': truth.shape[1] - 1,
+        'clones_estimated': table.shape[1] - 1,
+        'mass_error': np.mean(np.abs(table[:, 0] - truth[:, 0]) / truth[:, 0]),
+        'fraction_error': cost[row, col].sum() / f_true.size
+    }
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('out_dir')
+    parser.add_argument('--replicates', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--loci', type=int, default=10000)
+    parser.add_argument('--clones', type=int, default=2)
+    parser.add_argument('--samples', type=int, default=3)
+    parser.add_argument('--chroms', type=int, default=1)
+    parser.add_argument('--depth', type=float, default=30)
+    parser.add_argument('--snv-jumps', type=int, default=30)
+    parser.add_argument('--cna-events', type=int, default=0)
+    parser.add_argument('--loh-events', type=int, default=0)
+    args = parser.parse_args()
+
+    dirs = simulate_replicates(args.replicates, args.out_dir, processes=args.processes,
+                               random_state=args.seed, n_loci=args.loci, n_clones=args.clones,
+                               n_samples=args.samples, n_chroms=args.chroms, depth=args.depth,
+                               snv_jumps=args.snv_jumps, cna_events=args.cna_events,
+                               loh_events=args.loh_events)
+    sys.stdout.write('\n'.join(dirs) + '\n')
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Memory-mapped genome-wide matrix store
+"""
+
+# Load external dependencies
+from setup import *
+import os, json, shutil
+# Load internal dependencies
+import cache, utils
+
+# Locus coordinates kept alongside the matrix
+INDEX = ('chr_arabic', 'chr_roman', 'pos', 'pos_cum')
+
+VERSION = 1
+
+def _chunks(data, chunksize, **kwargs):
+    """
+    Iterate over a dataframe or a CSV file in chunks
+    """
+    if isinstance(data, pd.DataFrame):
+        yield data
+    else:
+        kwargs = utils.merge_two_dicts(cache.READ_CSV, kwargs)
+        for chunk in pd.read_csv(data, chunksize=chunksize, **kwargs):
+            yield chunk
+
+def build(data, path, value, columns, index=INDEX, chunksize=10**6, source=None, **kwargs):
+    """
+    Convert a long table into a dense float32 matrix of samples x loci
+
+    The matrix is stored with one row per sample, so that each sample is
+    a contiguous run along the genome. The table is read twice in chunks: once to collect the loci and the
+    sample keys, and once to fill a memory-mapped matrix in place. The
+    wide pivot is never held in memory. Missing entries are NaN; if a
+    (locus, sample) pair appears more than once, the last value is kept.
+
+    Input
+    -----
+      data : pandas dataframe or CSV filename
+      path : store directory
+      value : column holding the matrix values (e.g. 'score', 'mean')
+      columns : columns identifying a sample (e.g. ['resolution','selection','sample'])
+      index : locus coordinate columns; must include 'pos_cum'
+      chunksize : number of CSV rows read at a time
+      kwargs : arguments to pandas.read_csv
+    """
+    index = list(index)
+    columns = list(columns)
+    if 'pos_cum' not in index:
+        raise ValueError('index must include pos_cum')
+
+    # First pass: loci and sample keys
+    loci, keys = [], []
+    for chunk in _chunks(data, chunksize, **kwargs):
+        loci.append(chunk[index].drop_duplicates('pos_cum'))
+        keys.append(chunk[columns].drop_duplicates())
+    loci = pd.concat(loci).drop_duplicates('pos_cum').sort_values('pos_cum')
+    keys = pd.concat(keys).drop_duplicates().sort_values(columns)
+    samples = pd.MultiIndex.from_arrays([keys[c].values for c in columns], names=columns)
+    pos_cum = loci['pos_cum'].values
+
+    tmp = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    # Second pass: fill the matrix (samples x loci, so that each sample
+    # is a contiguous run along the genome)
+    matrix = np.lib.format.open_memmap(os.path.join(tmp, 'values.npy'), mode='w+',
+                                       dtype=np.float32, shape=(len(samples), len(pos_cum)))
+    matrix[:] = np.nan
+    for chunk in _chunks(data, chunksize, **kwargs):
+        rows = samples.get_indexer(pd.MultiIndex.from_arrays([chunk[c].values for c in columns]))
+        cols = np.searchsorted(pos_cum, chunk['pos_cum'].values)
+        matrix[rows, cols] = chunk[value].values.astype(np.float32)
+    matrix.flush()
+    del matrix
+
+    for c in index:
+        values = np.asarray(loci[c].values)
+        if not pd.api.types.is_numeric_dtype(loci[c]):
+            values = np.array([u'%s' % v for v in values], dtype='U')
+        np.save(os.path.join(tmp, 'index.%s.npy' % c), values)
+
+    meta = {
+        'version': VERSION,
+        'value': value,
+        'index': index,
+        'columns': columns,
+        'samples': [[v.item() if isinstance(v, np.generic) else v for v in k] for k in samples.tolist()],
+        'source': source
+    }
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+    return MatrixStore(path)
+
+
+class MatrixStore(object):
+    """
+    Memory-mapped matrix of samples x loci with a sorted `pos_cum` axis
+
+    Slicing by genomic range and by sample only reads the selected part
+    of the matrix from disk. `shape`, `array` and `frame` present it
+    transposed, as loci x samples (the layout of pandas.pivot_table).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.index = dict((c, np.load(os.path.join(path, 'index.%s.npy' % c), mmap_mode='r'))
+                          for c in self.meta['index'])
+        self.pos_cum = self.index['pos_cum']
+        self.samples = pd.MultiIndex.from_tuples([tuple(k) for k in self.meta['samples']],
+                                                 names=self.meta['columns'])
+
+    @property
+    def shape(self):
+        """
+        Number of loci and samples
+        """
+        return self.values.shape[::-1]
+
+    def locus_slice(self, start=None, end=None):
+        """
+        Locus positions covering the cumulative genomic range [start, end]
+        """
+        i = 0 if start is None else np.searchsorted(self.pos_cum, start, side='left')
+        j = len(self.pos_cum) if end is None else np.searchsorted(self.pos_cum, end, side='right')
+        return slice(i, j)
+
+    def sample_indexer(self, **levels):
+        """
+        Positions of the samples matching the given level values
+
+        Input
+        -----
+          levels : level name -> value or list of values
+                   (e.g. selection='RM', sample=['WAxNA_F12_1_RM_1'])
+        """
+        mask = np.ones(len(self.samples), dtype=bool)
+        for name, value in levels.items():
+            if not isinstance(value, (list, tuple, set, np.ndarray)):
+                value = [value]
+            mask &= self.samples.get_level_values(name).isin(value)
+        return np.flatnonzero(mask)
+
+    def array(self, start=None, end=None, **levels):
+        """
+        Dense float32 array (loci x samples) of a genomic range and a
+        subset of samples
+        """
+        loci = self.locus_slice(start, end)
+        cols = self.sample_indexer(**levels)
+        if len(cols) == len(self.samples):
+            return np.array(self.values[:, loci]).T
+        return np.array(self.values[cols, loci]).T
+
+    def frame(self, start=None, end=None, **levels):
+        """
+        Same as `array`, as a dataframe indexed by locus coordinates and
+        with the sample keys as columns (the layout of pandas.pivot_table)
+        """
+        loci = self.locus_slice(start, end)
+        cols = self.sample_indexer(**levels)
+        index = pd.MultiIndex.from_arrays([np.asarray(self.index[c][loci]) for c in self.meta['index']],
+                                          names=self.meta['index'])
+        return pd.DataFrame(self.array(start, end, **levels), index=index, columns=self.samples[cols])
+
+
+def open_store(fn, value, columns, index=INDEX, path=None, **kwargs):
+    """
+    Open the matrix store for a long CSV table, building it on first use
+
+    The store is rebuilt whenever the CSV file or the arguments it is
+    parsed with change.
+
+    Input
+    -----
+      fn : CSV filename
+      value, columns, index : see `build`
+      path : store directory (default: next to `fn`)
+      kwargs : arguments to `build`
+    """
+    if path is None:
+        path = fn + '.%s.store' % value
+    parse = dict((k, v) for k, v in kwargs.items() if k != 'chunksize')
+    source = cache.source_stamp(fn, utils.merge_two_dicts(cache.READ_CSV, parse))
+    source['layout'] = [value, list(columns), list(index)]
+    meta = os.path.join(path, 'meta.json')
+    if os.path.exists(meta):
+        with open(meta, 'r') as f:
+            stored = json.load(f)
+        if stored.get('version') == VERSION and stored.get('source') == source:
+            return MatrixStore(path)
+    return build(fn, path, value, columns, index=index, source=source, **kwargs)
@@ -0,0 +1,465 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Subclonal decomposition of every population with filterHD and cloneHD
+"""
+
+# Load external dependencies
+from setup import *
+import os, sys, glob, time, subprocess
+from multiprocessing import Pool, cpu_count
+# Load internal dependencies
+import tracks, results
+
+# Directory holding the filterHD and cloneHD binaries (see `make cloneHD`);
+# binaries missing from it are looked up in the system path
+BUILD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build')
+
+# Populations are looked up below this directory
+DATA_DIR = os.path.join(dir_data, 'seq', 'subclonality')
+
+# Input files and filterHD/cloneHD options of each kind of dataset
+LAYOUTS = {
+    'experiment': {
+        'bulk': 'snv_T0.txt',
+        'mixture': 'snv_T*_T*.txt',
+        'cna': None,
+        'filterHD_bulk': '--mode 1 --rnd 1e-8 --jump 0 --dist 1',
+        'filterHD_mixture': '--mode 1 --rnd 1e-8 --jumpi 1e-08 --sigmai 1.0e-4 --jumps 1',
+        'cloneHD': '--trials 5 --nmax 3 --force --snv-rnd 1.0e-4 --snv-jump 0.001'
+    },
+    'simulation': {
+        'bulk': 'bulk.snv.txt',
+        'mixture': 'mixture.snv.txt',
+        'cna': 'mixture.cna.txt',
+        'filterHD_bulk': '--mode 1 --rnd 1e-8 --jump 0 --dist 1',
+        'filterHD_mixture': '--mode 1 --rnd 1e-8 --jumps 1',
+        'cloneHD': '--cna {cna} --trials 5 --nmax 3 --force --max-tcn 2 --cna-jump 0 '
+                   '--snv-jumps {jumps} --min-jump 0.01 --restarts 10 --mass-gauging 1 '
+                   '--cna-pen-norm 0.9'
+    }
+}
+
+# Default number of OpenMP threads of a job
+THREADS = 4
+
+# Output prefix of each independent cloneHD run, appended to the prefix
+# of its time series
+RESTART = '.restart-%03d'
+
+def executable(name, build_dir=BUILD_DIR):
+    path = os.path.join(build_dir, name)
+    return path if os.path.exists(path) else name
+
+def discover(root=DATA_DIR):
+    """
+    Find the populations below `root`
+
+    A population is a directory holding the bulk SNV file of one of the
+    `LAYOUTS`; each of its mixture SNV files is a time series.
+
+    Output
+    -----
+      list of dicts with the name (path relative to `root`), directory,
+      layout, bulk filename, and the list of (series, mixture filename)
+    """
+    populations = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for layout in sorted(LAYOUTS):
+            spec = LAYOUTS[layout]
+            if spec['bulk'] not in filenames:
+                continue
+            mixtures = sorted(glob.glob(os.path.join(dirpath, spec['mixture'])))
+            if len(mixtures) == 1:
+                series = [('mixture', mixtures[0])]
+            else:
+                # One output prefix per time series, e.g. mixture.T2_T32
+                series = [('mixture.' + os.path.splitext(os.path.basename(fn))[0].split('_', 1)[-1], fn)
+                          for fn in mixtures]
+            populations.append({
+                'name': os.path.relpath(dirpath, root),
+                'path': dirpath,
+                'layout': layout,
+                'bulk': os.path.join(dirpath, spec['bulk']),
+                'series': series
+            })
+            break
+    return populations
+
+
+class Job(object):
+    """
+    One run of filterHD or cloneHD, with its output prefix, its input
+    files, the names of the jobs whose output it reads, and for
+    independent cloneHD runs, their seed
+    """
+    def __init__(self, name, population, series, step, command, log, deps=(), seed=None, pre=None,
+                 inputs=()):
+        self.name = name
+        self.population = population
+        self.series = series
+        self.step = step
+        self.command = command
+        self.log = log
+        self.deps = list(deps)
+        self.seed = seed
+        self.pre = pre
+        self.inputs = list(inputs)
+
+
+def restart_options(options, seed):
+    """
+    cloneHD options of a single trial with its own seed, replacing the
+    number of trials and restarts
+    """
+    options = list(options)
+    for flag in ['--trials', '--restarts', '--seed']:
+        while flag in options:
+            ii = options.index(flag)
+            del options[ii:ii+2]
+    return options + ['--trials', '1', '--seed', str(seed)]
+
+def population_jobs(population, results=None, build_dir=BUILD_DIR, restarts=1, seed=1):
+    """
+    Jobs of one population: the filterHD bulk pass, then the filterHD
+    mixture pass and cloneHD of each time series
+
+    With `restarts` above 1, cloneHD runs as that many independent
+    single-trial jobs with seeds `seed`, `seed`+1, ... instead of one job
+    running all trials and restarts (see `select_best`).
+
+    Input
+    -----
+      population : dict, as returned by `discover`
+      results : output directory (default: the population directory)
+      build_dir : directory holding the binaries
+      restarts : number of independent cloneHD runs of each time series
+      seed : seed of the first run
+
+    Output
+    -----
+      list of `Job`s
+    """
+    results = population['path'] if results is None else results
+    spec = LAYOUTS[population['layout']]
+    filterHD = executable('filterHD', build_dir)
+    cloneHD = executable('cloneHD', build_dir)
+    name = population['name']
+
+    bulk = os.path.join(results, 'bulk.snv')
+    jobs = [Job('%s:bulk' % name, name, None, 'filterHD_bulk',
+                [filterHD, '--data', population['bulk'], '--pre', bulk] + spec['filterHD_bulk'].split(),
+                bulk + '.log', pre=bulk, inputs=[population['bulk']])]
+
+    for series, fn in population['series']:
+        pre = os.path.join(results, series)
+        fields = {
+            'cna': os.path.join(population['path'], spec['cna'] or ''),
+            'jumps': pre + '.snv.jumps.txt'
+        }
+        mixture = Job('%s:%s:filterHD' % (name, series), name, series, 'filterHD_mixture',
+                      [filterHD, '--data', fn, '--pre', pre + '.snv'] + spec['filterHD_mixture'].split(),
+                      pre + '.snv.log', pre=pre + '.snv', inputs=[fn])
+        jobs.append(mixture)
+        options = spec['cloneHD'].format(**fields).split()
+        command = [cloneHD, '--snv', fn, '--bulk-mean', bulk + '.posterior-1.txt']
+        deps = [jobs[0].name, mixture.name]
+        inputs = [fn] + ([fields['cna']] if spec['cna'] else [])
+        if restarts > 1:
+            for ii in range(restarts):
+                run_pre = pre + RESTART % ii
+                jobs.append(Job('%s:%s:cloneHD:%d' % (name, series, ii), name, series, 'cloneHD_restart',
+                                command + ['--pre', run_pre] + restart_options(options, seed + ii),
+                                run_pre + '.log', deps=deps, seed=seed + ii, pre=run_pre, inputs=inputs))
+        else:
+            jobs.append(Job('%s:%s:cloneHD' % (name, series), name, series, 'cloneHD',
+                            command + ['--pre', pre] + options, pre + '.log', deps=deps, pre=pre,
+                            inputs=inputs))
+    return jobs
+
+def run_job(args):
+    """
+    Run one command with `threads` OpenMP threads, writing its output
+    to a log file
+
+    Input
+    -----
+      args : tuple (name, command, threads, log filename)
+
+    Output
+    -----
+      tuple (name, exit status, start time, wall time in seconds)
+    """
+    name, command, threads, log = args
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    start = time.time()
+    with open(log, 'w') as f:
+        f.write(' '.join(command) + '\n')
+        f.flush()
+        try:
+            status = subprocess.call(command, stdout=f, stderr=subprocess.STDOUT, env=env)
+        except OSError as e:
+            f.write('%s\n' % e)
+            status = 127
+    return name, status, start, time.time() - start
+
+def run_jobs(jobs, threads=THREADS, cores=None, poll=0.5, cache_dir=None, max_bytes=results.MAX_BYTES):
+    """
+    Run dependent jobs in a process pool
+
+    A job starts once the jobs it depends on have succeeded, and is
+    skipped if any of them failed. OpenMP threads are budgeted across
+    concurrent jobs: a job gets up to `threads` threads, fewer if needed
+    so that more ready jobs can start, and the threads of running jobs
+    never exceed `cores`.
+
+    With a `cache_dir`, each job is keyed by its command, the contents of
+    its input files and the keys of its dependencies (see
+    `results.job_key`). Jobs whose key is stored have their output files
+    copied in place instead of running, and the output of the jobs that
+    succeed is stored.
+
+    Input
+    -----
+      jobs : list of `Job`s
+      threads : maximum number of threads of a job
+      cores : number of available cores (default: all)
+      poll : interval between checks for finished jobs, in seconds
+      cache_dir : directory of the results store (default: no store)
+      max_bytes : size cap of the results store
+
+    Output
+    -----
+      pandas dataframe with one row per job and its population, series,
+      step, seed, threads, exit status, state ('ok', 'cached', 'failed'
+      or 'skipped'), start time, wall time and command
+    """
+    cores = cpu_count() if cores is None else cores
+    threads = max(1, min(threads, cores))
+    names = set(job.name for job in jobs)
+    for job in jobs:
+        for dep in job.deps:
+            if dep not in names:
+                raise KeyError('%s depends on unknown job %s' % (job.name, dep))
+
+    by_name = dict((job.name, job) for job in jobs)
+    pending = list(jobs)
+    running = {}
+    records = {}
+    keys, before = {}, {}
+    digests = results.read_digests(cache_dir) if cache_dir is not None else None
+
+    pool = Pool(cores)
+    try:
+        while pending or running:
+            # Jobs skipped, restored, started or finished in this round
+            progress = 0
+            # Skip the jobs of failed dependencies
+            for job in list(pending):
+                if any(records[d]['state'] not in ('ok', 'cached') for d in job.deps if d in records):
+                    records[job.name] = {'threads': 0, 'status': None, 'state': 'skipped',
+                                         'start': np.nan, 'seconds': np.nan}
+                    pending.remove(job)
+                    progress += 1
+            # Restore the ready jobs whose results are stored
+            ready = [job for job in pending if all(d in records for d in job.deps)]
+            if cache_dir is not None:
+                for job in [job for job in ready if job.name not in keys]:
+                    keys[job.name] = results.job_key(job.command, job.inputs, job.pre,
+                                                     [keys[d] for d in job.deps], digests)
+                    start = time.time()
+                    if results.load(keys[job.name], job.pre, cache_dir) is not None:
+                        records[job.name] = {'threads': 0, 'status': 0, 'state': 'cached',
+                                             'start': start, 'seconds': time.time() - start}
+                        pending.remove(job)
+                        progress += 1
+                ready = [job for job in ready if job.name not in records]
+            # Start the ready jobs within the thread budget
+            free = cores - sum(n for _, n in running.values())
+            for ii, job in enumerate(ready):
+                n = min(threads, max(1, free // (len(ready) - ii)))
+                if n > free:
+                    break
+                if cache_dir is not None:
+                    before[job.name] = results.snapshot(job.pre)
+                result = pool.apply_async(run_job, ((job.name, job.command, n, job.log),))
+                running[job.name] = (result, n)
+                pending.remove(job)
+                free -= n
+                progress += 1
+            # Collect finished jobs
+            done = [name for name, (result, _) in running.items() if result.ready()]
+            for name in done:
+                result, n = running.pop(name)
+                _, status, start, seconds = result.get()
+                records[name] = {'threads': n, 'status': status,
+                                 'state': 'ok' if status == 0 else 'failed',
+                                 'start': start, 'seconds': seconds}
+                if cache_dir is not None and status == 0:
+                    job = by_name[name]
+                    files = results.outputs(job.pre, before.pop(name), exclude=job.inputs)
+                    results.store(keys[name], job.pre, files, command=job.command,
+                                  cache_dir=cache_dir, max_bytes=max_bytes)
+            progress += len(done)
+            if not progress and not running and pending:
+                raise ValueError('circular dependencies between %s' %
+                                 ', '.join(job.name for job in pending))
+            if not progress and running:
+                time.sleep(poll)
+    finally:
+        pool.close()
+        pool.join()
+        if digests is not None:
+            results.write_digests(digests, cache_dir)
+
+    rows = []
+    for job in jobs:
+        r = records[job.name]
+        rows.append([job.population, job.series, job.step, job.seed, r['threads'], r['status'],
+                     r['state'], r['start'], r['seconds'], ' '.join(job.command)])
+    df = pd.DataFrame(rows, columns=['population', 'series', 'step', 'seed', 'threads', 'status',
+                                     'state', 'start', 'seconds', 'command'])
+    # Exit status of skipped jobs is missing
+    df['status'] = np.array([records[job.name]['status'] for job in jobs], dtype=object)
+    return df
+
+def summary_llh(fn):
+    """
+    Log-likelihood reported in a cloneHD summary file
+
+    Uses the total log-likelihood if the summary has one, the sum of the
+    log-likelihoods of each data type otherwise, and NaN if the file is
+    missing or reports none.
+    """
+    if not os.path.exists(fn):
+        return np.nan
+    info, _ = tracks.read_summary(fn)
+    llh = dict((k, v) for k, v in info.items()
+               if 'llh' in k.lower() and isinstance(v, float))
+    total = [v for k, v in llh.items() if 'total' in k.lower()]
+    if total:
+        return total[0]
+    return sum(llh.values()) if llh else np.nan
+
+def select_best(runs):
+    """
+    Keep the output of the independent cloneHD run of highest likelihood
+
+    The files of the best run are renamed to the prefix of the time
+    series, as if cloneHD had run once, and the files of the other runs
+    are deleted. The likelihood of every run is written to
+    <prefix>.restarts.csv.
+
+    Input
+    -----
+      runs : list of cloneHD restart `Job`s of one time series
+
+    Output
+    -----
+      pandas dataframe with the seed, log-likelihood and whether it is
+      the best run, one row per run
+    """
+    pre = runs[0].pre[:-len(RESTART % 0)]
+    llh = np.array([summary_llh(job.pre + '.summary.txt') for job in runs])
+    best = int(np.nanargmax(llh)) if np.isfinite(llh).any() else None
+    for ii, job in enumerate(runs):
+        for fn in glob.glob(job.pre + '.*'):
+            if ii == best:
+                os.rename(fn, pre + fn[len(job.pre):])
+            else:
+                os.remove(fn)
+    df = pd.DataFrame({'seed': [job.seed for job in runs], 'llh': llh,
+                       'best': np.arange(len(runs)) == best},
+                      columns=['seed', 'llh', 'best'])
+    df.to_csv(pre + '.restarts.csv', index=False)
+    return df
+
+def run(populations=None, root=DATA_DIR, out_dir=None, threads=THREADS, cores=None, build_dir=BUILD_DIR,
+        restarts=1, seed=1, cache_dir=results.CACHE_DIR, max_bytes=results.MAX_BYTES):
+    """
+    Subclonal decomposition of the populations below `root`
+
+    Input
+    -----
+      populations : names or directory basenames of the populations to
+          run (default: all, see `discover`)
+      root : directory holding the populations
+      out_dir : output directory, mirroring the layout of `root`
+          (default: write next to the input, as the shell scripts)
+      threads : maximum number of OpenMP threads of a job
+      cores : number of available cores (default: all)
+      build_dir : directory holding the binaries
+      restarts : number of independent cloneHD runs of each time series,
+          of which the best is kept (see `select_best`)
+      seed : seed of the first cloneHD run
+      cache_dir : directory of the results store, from which jobs whose
+          inputs and options are unchanged are served (None to run
+          every job)
+      max_bytes : size cap of the results store
+
+    Output
+    -----
+      pandas dataframe of jobs, see `run_jobs`, with the log-likelihood
+      of independent cloneHD runs and whether each is the best
+    """
+    found = discover(root)
+    if populations is not None:
+        wanted = set(populations)
+        found = [p for p in found if p['name'] in wanted or os.path.basename(p['path']) in wanted]
+        missing = wanted - set(p['name'] for p in found) - set(os.path.basename(p['path']) for p in found)
+        if missing:
+            raise KeyError('no population %s below %s' % (', '.join(sorted(missing)), root))
+    jobs = []
+    for p in found:
+        results = None if out_dir is None else os.path.join(out_dir, p['name'])
+        if results is not None and not os.path.exists(results):
+            os.makedirs(results)
+        jobs.extend(population_jobs(p, results, build_dir, restarts=restarts, seed=seed))
+    df = run_jobs(jobs, threads=threads, cores=cores, cache_dir=cache_dir, max_bytes=max_bytes)
+
+    # Keep the best of the independent cloneHD runs of each time series
+    df['llh'] = np.nan
+    df['best'] = False
+    groups = {}
+    for ii, job in enumerate(jobs):
+        if job.step == 'cloneHD_restart':
+            groups.setdefault((job.population, job.series), []).append(ii)
+    for idx in groups.values():
+        selected = select_best([jobs[ii] for ii in idx])
+        df.loc[df.index[idx], 'llh'] = selected['llh'].values
+        df.loc[df.index[idx], 'best'] = selected['best'].values
+    return df
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('populations', nargs='*', help='populations to run (default: all)')
+    parser.add_argument('--root', default=DATA_DIR)
+    parser.add_argument('--out-dir', default=None)
+    parser.add_argument('--threads', type=int, default=THREADS)
+    parser.add_argument('--cores', type=int, default=None)
+    parser.add_argument('--build-dir', default=BUILD_DIR)
+    parser.add_argument('--restarts', type=int, default=1,
+                        help='independent cloneHD runs of each time series, keeping the best')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the first cloneHD run')
+    parser.add_argument('--cache-dir', default=results.CACHE_DIR,
+                        help='store of finished results, keyed by inputs and options')
+    parser.add_argument('--no-cache', action='store_true', help='run every job')
+    parser.add_argument('--report', default=None, help='write the job table to a CSV file')
+    args = parser.parse_args()
+
+    df = run(args.populations or None, root=args.root, out_dir=args.out_dir, threads=args.threads,
+             cores=args.cores, build_dir=args.build_dir, restarts=args.restarts, seed=args.seed,
+             cache_dir=None if args.no_cache else args.cache_dir)
+    if args.report is not None:
+        df.to_csv(args.report, index=False)
+    sys.stdout.write(df.drop(['command', 'start'], axis=1).to_string(index=False) + '\n')
+    if args.restarts > 1:
+        # Spread of the log-likelihood across runs
+        llh = df[df['step'] == 'cloneHD_restart'].groupby(['population', 'series'])['llh']
+        spread = llh.agg(['count', 'max', 'median', 'min', 'std'])
+        sys.stdout.write('\nLog-likelihood of independent cloneHD runs\n' + spread.to_string() + '\n')
+    sys.exit(0 if df['state'].isin(['ok', 'cached']).all() else 1)
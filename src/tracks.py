@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Memory-mapped reader for filterHD/cloneHD tracks
+"""
+
+# Load external dependencies
+from setup import *
+import os, json, shutil
+# Load internal dependencies
+import cache
+
+VERSION = 1
+
+# Default arguments to pandas.read_csv for whitespace-delimited tracks
+READ_TRACK = {'sep': r'\s+', 'header': None, 'comment': '#'}
+
+def _meta_path(path):
+    return os.path.join(path, 'meta.json')
+
+def _track_path(fn, cache_dir=None):
+    if cache_dir is None:
+        return fn + '.track'
+    return os.path.join(cache_dir, os.path.basename(fn) + '.track')
+
+def read_comments(fn):
+    """
+    Comment lines ('#') of a text track, without the leading '#'
+    """
+    comments = []
+    with open(fn, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                comments.append(line[1:].strip())
+    return comments
+
+def write_track(fn, path, chrom_column=0, locus_column=1, source=None):
+    """
+    Convert a whitespace-delimited track into binary arrays
+
+    The chromosome and locus columns are stored as integer arrays and the
+    remaining columns as a single 2-D array (int32 if every value is an
+    integer, such as read counts, float64 otherwise). Rows are sorted by
+    chromosome and locus, so that regions are contiguous.
+
+    Input
+    -----
+      fn : text filename, e.g. mixture.snv.txt or bulk.snv.posterior-1.txt
+      path : output directory
+      chrom_column, locus_column : position of the chromosome and locus
+          columns (None for tracks without them, e.g. clones.txt)
+      source : optional stamp of the source file (see `cache.source_stamp`)
+    """
+    try:
+        df = pd.read_csv(fn, **READ_TRACK)
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame()
+    n = len(df)
+
+    index = [c for c in [chrom_column, locus_column] if c is not None]
+    if n == 0:
+        df = pd.DataFrame(columns=index, dtype=np.int64)
+    chrom = (df[chrom_column].values if chrom_column is not None else np.zeros(n)).astype(np.int32)
+    locus = (df[locus_column].values if locus_column is not None else np.arange(n)).astype(np.int64)
+    values = df[[c for c in df.columns if c not in index]].values
+    if values.dtype.kind in 'iub':
+        values = values.astype(np.int32)
+    else:
+        values = values.astype(np.float64)
+
+    # Sort by chromosome and locus
+    if n and np.any((np.diff(chrom) < 0) | ((np.diff(chrom) == 0) & (np.diff(locus) < 0))):
+        order = np.lexsort((locus, chrom))
+        chrom, locus, values = chrom[order], locus[order], values[order]
+
+    # Write to a temporary directory and move it in place
+    tmp = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'chrom.npy'), np.ascontiguousarray(chrom))
+    np.save(os.path.join(tmp, 'locus.npy'), np.ascontiguousarray(locus))
+    np.save(os.path.join(tmp, 'values.npy'), np.ascontiguousarray(values))
+
+    meta = {
+        'version': VERSION,
+        'nrows': n,
+        'ncols': values.shape[1],
+        'chroms': [int(c) for c in np.unique(chrom)],
+        'comments': read_comments(fn),
+        'source': source
+    }
+    with open(_meta_path(tmp), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+class Track(object):
+    """
+    A filterHD/cloneHD track: one row per locus, with its chromosome,
+    locus and value columns (read counts, depth, or the posterior of
+    each clone or sample)
+
+    Arrays are memory-mapped, and so are the tracks returned by `region`,
+    which read only the rows they select.
+
+    Input
+    -----
+      chrom, locus : arrays of chromosomes and loci
+      values : 2-D array of values
+      comments : comment lines of the source file
+      names : optional names of the value columns
+    """
+    def __init__(self, chrom, locus, values, comments=None, names=None):
+        self.chrom = chrom
+        self.locus = locus
+        self.values = values
+        self.comments = comments or []
+        self.names = list(names) if names is not None else list(range(values.shape[1]))
+        if len(self.names) != values.shape[1]:
+            raise ValueError('%d names for %d value columns' % (len(self.names), values.shape[1]))
+
+    def __len__(self):
+        return len(self.locus)
+
+    def __repr__(self):
+        return '<Track: %d loci, %d chromosomes, %d columns>' % (
+            len(self), len(self.chromosomes()), self.values.shape[1])
+
+    def chromosomes(self):
+        """
+        Chromosomes of the track, in order
+        """
+        if len(self) == 0:
+            return np.array([], dtype=np.int32)
+        return np.unique(np.asarray(self.chrom))
+
+    def _rows(self, chrom):
+        lo = np.searchsorted(self.chrom, chrom, side='left')
+        hi = np.searchsorted(self.chrom, chrom, side='right')
+        return lo, hi
+
+    def region(self, chrom, start=None, stop=None):
+        """
+        Loci of chromosome `chrom` between `start` and `stop` (inclusive)
+
+        Output
+        -----
+          `Track` of views into the arrays of this track
+        """
+        lo, hi = self._rows(chrom)
+        locus = self.locus[lo:hi]
+        a = lo + (np.searchsorted(locus, start, side='left') if start is not None else 0)
+        b = lo + (np.searchsorted(locus, stop, side='right') if stop is not None else hi - lo)
+        return Track(self.chrom[a:b], self.locus[a:b], self.values[a:b],
+                     self.comments, self.names)
+
+    def column(self, name):
+        """
+        Values of one column
+        """
+        return self.values[:, self.names.index(name)]
+
+    def frame(self):
+        """
+        The track as a pandas dataframe with columns chr_arabic, pos and
+        one column per value column (loads the data into memory)
+        """
+        df = pd.DataFrame(np.asarray(self.values), columns=self.names)
+        df.insert(0, 'pos', np.asarray(self.locus))
+        df.insert(0, 'chr_arabic', np.asarray(self.chrom))
+        return df
+
+
+def load_track(path, names=None, mmap_mode='r'):
+    """
+    Open a converted track (see `write_track`)
+    """
+    with open(_meta_path(path), 'r') as f:
+        meta = json.load(f)
+    arrays = [np.load(os.path.join(path, k + '.npy'), mmap_mode=mmap_mode)
+              for k in ['chrom', 'locus', 'values']]
+    return Track(*arrays, comments=meta['comments'], names=names)
+
+def is_fresh(path, source):
+    """
+    Check whether the converted track exists and was built from the given source
+    """
+    if not os.path.exists(_meta_path(path)):
+        return False
+    with open(_meta_path(path), 'r') as f:
+        meta = json.load(f)
+    return meta.get('version') == VERSION and meta.get('source') == source
+
+def read_track(fn, names=None, cache_dir=None, chrom_column=0, locus_column=1):
+    """
+    Read a filterHD/cloneHD text track through its binary copy
+
+    The first call parses the text file and writes the binary arrays next
+    to it (or in `cache_dir`). Later calls memory-map them, as long as the
+    source file is unchanged.
+
+    Input
+    -----
+      fn : text filename, e.g. mixture.snv.txt, mixture.true.xsnv.txt or
+          bulk.snv.posterior-1.txt
+      names : optional names of the value columns
+      cache_dir : directory holding the binary copy (default: next to `fn`)
+      chrom_column, locus_column : position of the chromosome and locus
+          columns (None for tracks without them)
+
+    Output
+    -----
+      `Track`
+    """
+    path = _track_path(fn, cache_dir)
+    source = cache.source_stamp(fn, {'chrom_column': chrom_column, 'locus_column': locus_column})
+    if not is_fresh(path, source):
+        write_track(fn, path, chrom_column=chrom_column, locus_column=locus_column, source=source)
+    return load_track(path, names=names)
+
+def read_summary(fn):
+    """
+    Read a cloneHD summary file
+
+    Comment lines of the form 'key: value' or 'key = value' (several per
+    line, separated by commas) are read into a dictionary, with numeric
+    values converted to floats. The other lines are read as a table of
+    numbers, e.g. the mass and clonal fractions of each sample.
+
+    Output
+    -----
+      tuple (dict, 2-D array)
+    """
+    info, rows = {}, []
+    with open(fn, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                for field in line[1:].split(','):
+                    m = re.match(r'\s*([^:=]+?)\s*[:=]\s*(\S+)', field)
+                    if m is None:
+                        continue
+                    key, value = m.groups()
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        pass
+                    info[key] = value
+            else:
+                try:
+                    rows.append([float(v) for v in line.split()])
+                except ValueError:
+                    continue
+    width = max([len(r) for r in rows] or [0])
+    table = np.full((len(rows), width), np.nan)
+    for ii, r in enumerate(rows):
+        table[ii, :len(r)] = r
+    return info, table
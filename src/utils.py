@@ -42,24 +42,62 @@ def merge_two_dicts(x, y):
     return z
 	
 	
+def encode_pairs(a, b, mirror=True, categories=None):
+    """
+	Encode two columns (e.g. MATa and MATα) as pairs of integer codes
+
+    Input
+    -----
+      a, b : array-like of values
+      mirror : if True, pairs are unordered and each pair is stored
+          with the lower code first; otherwise (a, b) order is kept
+      categories : sorted values to encode against (default: union of
+          `a` and `b`). Values not in `categories` get code -1 and, if
+          mirrored, are placed first.
+
+    Output
+    -----
+      codes : integer array of shape (n, 2)
+      categories : pandas index of the encoded values
+    """
+    a, b = np.asarray(a, dtype=object), np.asarray(b, dtype=object)
+    if categories is None:
+        categories = pd.Index(pd.unique(np.r_[a, b])).sort_values()
+    else:
+        categories = pd.Index(categories)
+    codes = np.column_stack([categories.get_indexer(a), categories.get_indexer(b)])
+    if mirror:
+        swap = ~(codes[:,1] > codes[:,0])
+        codes[swap] = codes[swap][:,::-1]
+    return codes, categories
+
+
 def combine_columns(df, c1, c2, mirror=True):
-    from itertools import combinations
-	
+    """
+	Combine two columns into a column of (c1, c2) tuples
+
+    If mirrored, a pair is kept in (c1, c2) order when c1 sorts before
+    c2 among the values of c1, and is swapped otherwise.
+
+    Input
+    -----
+      df : pandas dataframe, sorted in place by [c1, c2]
+      c1, c2 : column names
+      mirror : treat pairs as unordered
+
+    Output
+    -----
+      pandas series of tuples aligned with `df`
+    """
     df.sort_values([c1,c2], inplace=True)
-    comb = list(combinations(df[c1].unique(),2))
-    
-    genotype=[]
-    for index, row in df.iterrows():
-        if mirror:
-            if (row[c1], row[c2]) in comb:
-                g = (row[c1],row[c2])
-            else:
-                g = (row[c2],row[c1])
-        else:
-            g = (row[c1],row[c2])
-        genotype.append(g)
-            
-    return genotype
+    a, b = df[c1].values.astype(object), df[c2].values.astype(object)
+    if mirror:
+        codes, _ = encode_pairs(a, b, mirror=False, categories=pd.Index(df[c1].unique()))
+        swap = ~(codes[:,1] > codes[:,0])
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+    genotype = np.empty(len(df), dtype=object)
+    genotype[:] = list(zip(a, b))
+    return pd.Series(genotype, index=df.index)
 
     
 def simple_axes(ax):
@@ -148,24 +186,237 @@ def discrete_colormap(N, base_cmap=None):
     return base.from_list(cmap_name, color_list, N)
 
 
-def percentile(data):
+def percentile(data, axis=0):
     """
 	Calculate the median and top/bottom percentiles
     
     Input
     -----
-      data : pandas series or dataframe
-    """
-    median = np.zeros(data.shape[1])
-    perc_25 = np.zeros(data.shape[1])
-    perc_75 = np.zeros(data.shape[1])
-    for i in range(0, len(median)):
-        median[i] = np.median(data[:, i])
-        perc_25[i] = np.percentile(data[:, i], 25)
-        perc_75[i] = np.percentile(data[:, i], 75)
+      data : array (or pandas dataframe) of values
+      axis : axis along which the percentiles are computed (default: per column)
+
+    Output
+    -----
+      median, 25th and 75th percentiles
+    """
+    median, perc_25, perc_75 = np.percentile(np.asarray(data), [50, 25, 75], axis=axis)
     return median, perc_25, perc_75
 
 
+class QuantileSketch(object):
+    """
+    Mergeable streaming quantile summary
+
+    Values are kept as weighted centroids, finer at the tails than around
+    the median (as in a t-digest), so that memory stays bounded by the
+    `compression` parameter whatever the number of values. Sketches built
+    on separate chunks or in separate workers can be merged into one, and
+    pickled. Quantiles are exact until the first compression, and follow
+    the linear interpolation of `np.percentile`. NaNs are ignored.
+
+    Input
+    -----
+      compression : number of centroids kept, roughly (default 200)
+    """
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._buffer = []
+        self._buffered = 0
+
+    def update(self, values):
+        """
+        Add an array of values
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self._buffer.append(values)
+        self._buffered += len(values)
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self._buffered > 10 * self.compression:
+            self._flush()
+        return self
+
+    def merge(self, other):
+        """
+        Add the values summarised by another sketch
+        """
+        other._flush()
+        self._flush()
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(np.r_[self.means, other.means], np.r_[self.weights, other.weights])
+        return self
+
+    def _flush(self):
+        if self._buffer:
+            values = np.concatenate(self._buffer)
+            self._buffer, self._buffered = [], 0
+            self._compress(np.r_[self.means, values], np.r_[self.weights, np.ones(len(values))])
+
+    def _compress(self, means, weights):
+        """
+        Merge neighbouring centroids falling in the same unit of the
+        scale function k(q) = compression / (2 pi) * arcsin(2q - 1)
+        """
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        if len(means) <= self.compression:
+            self.means, self.weights = means, weights
+            return
+        q = (np.cumsum(weights) - weights/2.) / total
+        k = np.floor(self.compression / (2*np.pi) * np.arcsin(2*q - 1))
+        # Centroids are sorted, so each unit of k is a contiguous run
+        _, group = np.unique(k, return_inverse=True)
+        w = np.bincount(group, weights=weights)
+        self.means = np.bincount(group, weights=means*weights) / w
+        self.weights = w
+
+    def quantile(self, q):
+        """
+        Estimated quantile(s), for q in [0, 1]
+        """
+        self._flush()
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        mid = np.cumsum(self.weights) - self.weights/2.
+        xp = np.r_[0.5, mid, self.count - 0.5]
+        fp = np.r_[self.min, self.means, self.max]
+        return np.interp(np.asarray(q, dtype=float) * (self.count - 1) + 0.5, xp, fp)
+
+    def percentile(self, q):
+        """
+        Estimated percentile(s), for q in [0, 100]
+        """
+        return self.quantile(np.asarray(q, dtype=float) / 100.)
+
+def merge_sketches(sketches, compression=None):
+    """
+    Combine quantile sketches (e.g. built by separate workers) into one
+    """
+    sketches = list(sketches)
+    if compression is None:
+        compression = max([s.compression for s in sketches] or [200])
+    merged = QuantileSketch(compression)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
+
+
+class Histogram(object):
+    """
+    Histogram accumulator with fixed bin edges
+
+    Counts can be added chunk by chunk and merged across workers, so that
+    the distribution of a large dataset (e.g. genome-wide allele
+    frequencies of all samples) never needs to be held in memory. Values
+    outside the edges are counted separately; NaNs are ignored. As in
+    `np.histogram`, the last bin includes its right edge.
+
+    Input
+    -----
+      edges : bin edges, or number of bins if `range` is given
+      range : (min, max) of the bins
+    """
+    def __init__(self, edges, range=None):
+        if range is not None:
+            edges = np.linspace(range[0], range[1], int(edges) + 1)
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.outside = 0
+        widths = np.diff(self.edges)
+        self._uniform = np.allclose(widths, widths[0])
+
+    def update(self, values):
+        """
+        Add an array of values
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        lo, hi = self.edges[0], self.edges[-1]
+        inside = (values >= lo) & (values <= hi)
+        self.outside += int(len(values) - inside.sum())
+        values = values[inside]
+        nbins = len(self.counts)
+        if self._uniform:
+            idx = ((values - lo) / (hi - lo) * nbins).astype(np.int64)
+            # Correct for rounding at the bin edges
+            idx -= values < self.edges[idx]
+            idx += (idx < nbins - 1) & (values >= self.edges[np.minimum(idx + 1, nbins)])
+        else:
+            idx = np.searchsorted(self.edges, values, side='right') - 1
+        idx = np.clip(idx, 0, nbins - 1)
+        self.counts += np.bincount(idx, minlength=nbins)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another accumulator with the same edges
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('cannot merge histograms with different bin edges')
+        self.counts += other.counts
+        self.outside += other.outside
+        return self
+
+    @property
+    def count(self):
+        """
+        Number of values within the edges
+        """
+        return int(self.counts.sum())
+
+    def fraction(self):
+        """
+        Fraction of the observations in each bin
+        """
+        return self.counts / float(max(self.count, 1))
+
+    def density(self):
+        """
+        Probability density in each bin (integrates to 1)
+        """
+        return self.fraction() / np.diff(self.edges)
+
+    def step(self, norm='fraction'):
+        """
+        Coordinates of the step curve of the histogram
+
+        Input
+        -----
+          norm : 'fraction' (of observations), 'density' or 'count'
+
+        Output
+        -----
+          x, y with two points per bin, at its left and right edges
+        """
+        values = {'fraction': self.fraction, 'density': self.density,
+                  'count': lambda: self.counts.astype(float)}[norm]()
+        x = np.column_stack([self.edges[:-1], self.edges[1:]]).ravel()
+        y = np.repeat(values, 2)
+        return x, y
+
+def merge_histograms(histograms):
+    """
+    Combine histogram accumulators (e.g. built by separate workers) into one
+    """
+    histograms = list(histograms)
+    merged = Histogram(histograms[0].edges)
+    for h in histograms:
+        merged.merge(h)
+    return merged
+
+
 def stars(p):
     """
 	Convert p-values to star notation
@@ -260,27 +511,124 @@ def rgb_to_hex(rgb):
 	"""
     return '#%02x%02x%02x' % rgb
 
+class GenomeCoordinates(object):
+    """
+    Convert between (chromosome, position) and cumulative genome-wide
+    positions using array lookups
+
+    Positions are 1-based, so that position p on a chromosome starting
+    at cumulative coordinate s maps to s + p.
+
+    Input
+    -----
+      chrom_len : dict of chromosome -> length (default: config.chrom_len)
+      offset : gap between consecutive chromosomes (default 0 bp)
+    """
+    def __init__(self, chrom_len=None, offset=0):
+        if chrom_len is None:
+            chrom_len = config.chrom_len
+        self.chroms = np.array(sorted(chrom_len))
+        self.lengths = np.array([chrom_len[c] for c in self.chroms], dtype=np.int64)
+        self.starts = np.r_[0, np.cumsum(self.lengths + offset)[:-1]].astype(np.int64)
+        self.ends = self.starts + self.lengths
+        self._frame = None
+
+    def index(self, chrom):
+        """
+        Position of each chromosome in the sorted chromosome array
+        """
+        chrom = np.asarray(chrom)
+        idx = np.clip(np.searchsorted(self.chroms, chrom), 0, len(self.chroms)-1)
+        unknown = self.chroms[idx] != chrom
+        if np.any(unknown):
+            raise KeyError('unknown chromosome(s): %s' % np.unique(np.asarray(chrom)[unknown]))
+        return idx
+
+    def to_cum(self, chrom, pos):
+        """
+        Cumulative position of each (chromosome, position) pair
+        """
+        return self.starts[self.index(chrom)] + np.asarray(pos)
+
+    def from_cum(self, pos_cum):
+        """
+        Chromosome and position of each cumulative position
+        """
+        pos_cum = np.asarray(pos_cum)
+        idx = np.clip(np.searchsorted(self.starts, pos_cum, side='left') - 1, 0, len(self.chroms)-1)
+        return self.chroms[idx], pos_cum - self.starts[idx]
+
+    def annotate(self, df, chrom='chr_arabic'):
+        """
+        Add cumulative coordinates to a dataframe
+
+        Adds `pos_cum` if the frame has a `pos` column, and `start_cum`
+        and `end_cum` if it has both `start` and `end` columns.
+        """
+        df = df.copy()
+        offset = self.starts[self.index(df[chrom].values)]
+        if 'start' in df and 'end' in df:
+            df['start_cum'] = df['start'].values + offset
+            df['end_cum'] = df['end'].values + offset
+        if 'pos' in df:
+            df['pos_cum'] = df['pos'].values + offset
+        return df
+
+    def frame(self):
+        """
+        Chromosome lengths and start/end coordinates as a dataframe
+        """
+        if self._frame is None:
+            df = pd.DataFrame({'chr_arabic': self.chroms, 'chr_length': self.lengths},
+                              columns=['chr_arabic', 'chr_length'])
+            df['chr_roman'] = df['chr_arabic'].apply(int_to_roman)
+            df['chr_start'] = self.starts
+            df['chr_end'] = self.ends
+            self._frame = df
+        return self._frame.copy()
+
+# Coordinates of each reference genome, computed once
+_GENOMES = {}
+
+def genome_coordinates(chrom_len=None, offset=0):
+    """
+    Shared `GenomeCoordinates` of a reference genome
+
+    The coordinates are computed on the first call for a given set of
+    chromosome lengths and reused afterwards; their arrays are read-only.
+    """
+    if chrom_len is None:
+        chrom_len = config.chrom_len
+    key = (tuple(sorted(chrom_len.items())), offset)
+    if key not in _GENOMES:
+        genome = GenomeCoordinates(chrom_len, offset=offset)
+        for arr in [genome.chroms, genome.lengths, genome.starts, genome.ends]:
+            arr.flags.writeable = False
+        _GENOMES[key] = genome
+    return _GENOMES[key]
+
 def chr_coords():
-	# Load config file with chromosome lengths
-    df = pd.DataFrame(config.chrom_len.items(), columns=['chr_arabic', 'chr_length'])
-    df['chr_roman'] = df['chr_arabic'].apply(int_to_roman)
-	# Calculate start/end coordinates
-    df['chr_start'] = ((df['chr_length'].rolling(window=2,center=False).sum() - df['chr_length']).fillna(0)).cumsum(axis=0).astype(int)
-    df['chr_end'] = (df['chr_length']).cumsum(axis=0)
-    return df
+    """
+	Chromosome start/end coordinates of the reference genome
+	"""
+    return genome_coordinates().frame()
 
 def chr_to_gw(df, chr_coords):
-    
-    df = df.merge(chr_coords, how='left', on='chr_arabic')
+    """
+	Add genome-wide coordinates (pos_cum, start_cum/end_cum) to a
+	dataframe with a `chr_arabic` column
 
-    if 'start' and 'end' in df:
-        df['start_cum'] = df.start + df.chr_start
-        df['end_cum'] = df.end + df.chr_start
-    if 'pos' in df:
-        df['pos_cum'] = df.pos + df.chr_start
-    
-    df = df.drop(['chr_start','chr_end'], axis=1)
-    
+    Input
+    -----
+      df : pandas dataframe
+      chr_coords : chromosome coordinates, as returned by `chr_coords`
+    """
+    genome = genome_coordinates(dict(zip(chr_coords.chr_arabic, chr_coords.chr_length)))
+    df = genome.annotate(df)
+    idx = genome.index(df['chr_arabic'].values)
+    for c in ['chr_length', 'chr_roman']:
+        if c in chr_coords and c not in df:
+            df[c] = chr_coords.set_index('chr_arabic')[c].reindex(genome.chroms).values[idx]
     return df
 	
 def est_cum_pos(position, aggregation='chrom', column='pos', offset=0, chrom_len=None):
@@ -301,21 +649,13 @@ def est_cum_pos(position, aggregation='chrom', column='pos', offset=0, chrom_len
       position:   augmented position object where cumulative positions are defined
     """
     RV = position.copy()
-    chromvals =  sp.unique(position[aggregation]) # sp.unique is always sorted
-    chrom_pos_cum= sp.zeros_like(chromvals) # get the starting position of each Chrom
-    pos_cum= sp.zeros_like(position.shape[0])
-    if not column+'_cum' in position:
-        RV[column+'_cum']= sp.zeros_like(position[column]) # get the cum_pos of each variant.
-    pos_cum=RV[column+'_cum'].values
-    maxpos_cum=0
-    for i,mychrom in enumerate(chromvals):
-        chrom_pos_cum[i] = maxpos_cum
-        i_chr=position[aggregation]==mychrom
-        if chrom_len is None:
-            maxpos = position[column][i_chr].max()+offset
-        else:
-            maxpos = chrom_len[mychrom]+offset
-        pos_cum[i_chr.values]=maxpos_cum+position.loc[i_chr,column]
-        maxpos_cum+=maxpos      
-    
-    return RV, chrom_pos_cum
\ No newline at end of file
+    chromvals, inverse = np.unique(position[aggregation].values, return_inverse=True)
+    if chrom_len is None:
+        # Span each chromosome up to its last observed position
+        maxpos = pd.Series(position[column].values).groupby(inverse).max().values
+        chrom_len = dict(zip(chromvals, maxpos))
+    genome = GenomeCoordinates(dict((c, chrom_len[c]) for c in chromvals), offset=offset)
+    RV[column+'_cum'] = genome.starts[inverse] + position[column].values
+    chrom_pos_cum = genome.starts.astype(chromvals.dtype)
+
+    return RV, chrom_pos_cum
@@ -0,0 +1,19 @@
+import os
+
+import pandas as pd
+import pytest
+
+import cache, pipeline
+
+@pytest.mark.parametrize('fn', [
+    'pheno/populations/pheno_populations.csv.gz',
+    'seq/background/seq_background_qtl_llh.csv.gz',
+    'seq/de-novo/seq_de_novo_cn_loh.csv.gz',
+])
+def test_read_csv_matches_pandas(tmpdir, fn):
+    fn = os.path.join(pipeline.DATA_DIR, fn)
+    expected = pd.read_csv(fn, low_memory=False, **cache.READ_CSV)
+    # Built, then served from the cache
+    for _ in range(2):
+        df = cache.read_csv(fn, cache_dir=str(tmpdir), categories=())
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
@@ -0,0 +1,17 @@
+import os
+
+import pandas as pd
+
+import cache, pipeline
+
+def test_drivers_match_pivot_table(tmpdir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'CACHE_DIR', str(tmpdir))
+    fn = os.path.join(pipeline.DATA_DIR, 'seq/de-novo/seq_de_novo_snv_indel.csv')
+    df = pd.read_csv(fn, **cache.READ_CSV)
+    df = df[df.mutation_type == 'driver']
+    expected = pd.pivot_table(df, index=['selection', 'population'],
+                              columns=['chr_arabic', 'chr_roman', 'pos', 'pos_cum', 'gene'],
+                              values='frequency')
+    # Computed, then served from the cache
+    for _ in range(2):
+        pd.testing.assert_frame_equal(pipeline.get('seq_de_novo_drivers'), expected)
@@ -0,0 +1,40 @@
+import os, stat
+
+import subclonality
+
+# Stand-ins for filterHD and cloneHD: write one output file per prefix
+FAKE = '''#!/bin/sh
+while [ $# -gt 0 ]; do
+  if [ "$1" = "--pre" ]; then pre=$2; fi
+  shift
+done
+echo "$0" > "$pre.posterior-1.txt"
+echo "# total llh = -1000" > "$pre.summary.txt"
+'''
+
+def _population(tmpdir):
+    build = tmpdir.mkdir('build')
+    for name in ['filterHD', 'cloneHD']:
+        fn = build.join(name)
+        fn.write(FAKE)
+        os.chmod(str(fn), os.stat(str(fn)).st_mode | stat.S_IEXEC)
+    path = tmpdir.mkdir('pop')
+    path.join('snv_T0.txt').write('1 100 10 20\n')
+    path.join('snv_T2_T8.txt').write('1 100 5 20\t6 20\n')
+    path.join('snv_T2_T32.txt').write('1 100 7 20\t8 20\n')
+    population = subclonality.discover(str(tmpdir))[0]
+    return population, str(build)
+
+def test_run_jobs_twice_serves_results_from_store(tmpdir):
+    population, build = _population(tmpdir)
+    cache_dir = str(tmpdir.join('store'))
+    jobs = subclonality.population_jobs(population, build_dir=build)
+
+    first = subclonality.run_jobs(jobs, threads=1, cores=2, poll=0.01, cache_dir=cache_dir)
+    assert (first['state'] == 'ok').all()
+    summary = os.path.join(population['path'], 'mixture.T2_T8.summary.txt')
+    os.remove(summary)
+
+    second = subclonality.run_jobs(jobs, threads=1, cores=2, poll=0.01, cache_dir=cache_dir)
+    assert (second['state'] == 'cached').all()
+    assert os.path.exists(summary)